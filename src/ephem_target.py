@@ -1,12 +1,85 @@
 import json
+from multiprocessing.pool import ThreadPool
 
+import numpy
 from astropy import units
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
 from xml.dom import minidom
 import xml
-from astropy.coordinates import SkyCoord
 
 COLUMN_SEPARATOR = "|"
 
+EPHEM_FORMATS = ['CFHT ET', 'CFHT API', 'GEMINI ET']
+
+MJD_ZERO_POINT = 2400000.5
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# Number of ephemeris lines formatted and written together by the streaming writers.
+ROWS_PER_WRITE = 4096
+
+# Storage of the ephemeris points of a target, rates are in arcsec/hour with the RA rate including cos(Dec).
+POINT_DTYPE = numpy.dtype([('mjd', 'f8'),
+                           ('ra_deg', 'f8'),
+                           ('dec_deg', 'f8'),
+                           ('mag', 'f8'),
+                           ('dra', 'f8'),
+                           ('ddec', 'f8')])
+
+
+def _escape(value):
+    """
+    Escape text and attribute values the way minidom does when writing a document.
+    """
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace('"', "&quot;").replace(">", "&gt;")
+
+
+def _sexagesimal(value, modulus, precision, sep, sign):
+    """
+    Format values, in the units of the first sexagesimal field, as DD:MM:SS.s strings.
+
+    The whole value is rounded to the requested precision of seconds before it is split into fields, so a carry out
+    of the seconds propagates into the minutes and degrees (or hours) rather than producing 60 seconds.
+    """
+    scale = 10 ** precision
+    units_per_field = 3600 * scale
+    n = numpy.round(numpy.abs(value) * units_per_field).astype('i8')
+    if modulus is not None:
+        n %= modulus * units_per_field
+    first, rest = numpy.divmod(n, units_per_field)
+    minutes, rest = numpy.divmod(rest, 60 * scale)
+    seconds, fraction = numpy.divmod(rest, scale)
+    if sign:
+        signs = numpy.where(numpy.signbit(value), '-', '+').tolist()
+    else:
+        signs = [''] * len(n)
+    if precision > 0:
+        template = "{}{:02d}" + sep + "{:02d}" + sep + "{:02d}.{:0" + str(precision) + "d}"
+        return [template.format(*parts)
+                for parts in zip(signs, first.tolist(), minutes.tolist(), seconds.tolist(), fraction.tolist())]
+    template = "{}{:02d}" + sep + "{:02d}" + sep + "{:02d}"
+    return [template.format(*parts) for parts in zip(signs, first.tolist(), minutes.tolist(), seconds.tolist())]
+
+
+def format_ra(ra, precision=2, sep=':'):
+    """
+    Format right ascensions as zero padded HH:MM:SS.ss strings.
+
+    :param ra: numpy array of right ascensions, in degrees.
+    :return: list of str
+    """
+    return _sexagesimal(numpy.atleast_1d(ra) / 15.0, 24, precision, sep, sign=False)
+
+
+def format_dec(dec, precision=1, sep=':'):
+    """
+    Format declinations as zero padded, signed, +DD:MM:SS.s strings.
+
+    :param dec: numpy array of declinations, in degrees.
+    :return: list of str
+    """
+    return _sexagesimal(numpy.atleast_1d(dec), None, precision, sep, sign=True)
+
 
 def create_astrores_document():
     implementation = xml.dom.getDOMImplementation()
@@ -30,20 +103,48 @@ class EphemTarget(object):
                            "DESCRIPTION": "Right ascension of target"},
               "DEC_J2000": {"attr": {"datatype": "A", "width": "11", "format": "DEd:DEm:DEs", "unit": "deg"},
                             "DESCRIPTION": "Declination of target"}}
+    field_names = ["DATE_UTC", "RA_J2000", "DEC_J2000"]
 
-    def __init__(self, name, column_separator=COLUMN_SEPARATOR, format='CFHT ET', runid='16BP06')
+    def __init__(self, name, column_separator=COLUMN_SEPARATOR, ephem_format='CFHT ET', runid='16BP06',
+                 compact=False):
         """
         create an ephmeris target, either with a 'orbfit' object or some mean rate of motion.
 
         :param name: a string containing the name of the target.
+        :param ephem_format: one of EPHEM_FORMATS, or a list of them, None for CFHT ET.
+        :param compact: write the CFHT API JSON without whitespace between items.
         """
 
         self.name = str(name).replace(" ","_")
-        self.format = format
+        self.format = ephem_format is None and EPHEM_FORMATS[0] or ephem_format
         self.doc = create_astrores_document()
         self.column_separator = column_separator
-        self.coordinates = []
+        self._points = numpy.zeros(0, dtype=POINT_DTYPE)
+        self._pending = []
         self.runid = runid
+        self.compact = compact
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def points(self):
+        """
+        The ephemeris points as a numpy structured array, with POINT_DTYPE, in the order they were added.
+        """
+        if self._pending:
+            self._points = numpy.concatenate([self._points] + self._pending)
+            self._pending = []
+        return self._points
+
+    @property
+    def coordinates(self):
+        """
+        The ephemeris points as a SkyCoord array, with the times as obstime.
+        """
+        points = self.points
+        return SkyCoord(points['ra_deg'] * units.degree, points['dec_deg'] * units.degree,
+                        obstime=Time(points['mjd'], format='mjd', scale='utc'))
 
     def _init_cfht_api_(self):
         return {'runid': "16BE91",
@@ -138,38 +239,183 @@ class EphemTarget(object):
         return header_lines
 
     def append(self, coordinate):
-        self.coordinates.append(coordinate)
+        """
+        Add one ephemeris point.
+
+        :param coordinate: SkyCoord with obstime and mag attributes, and optionally dra and ddec rates in arcsec/hour.
+        """
+        self.extend(coordinate.obstime, coordinate.ra.degree, coordinate.dec.degree, coordinate.mag,
+                    dra=getattr(coordinate, 'dra', None), ddec=getattr(coordinate, 'ddec', None))
+
+    def extend(self, times, ra, dec, mag, dra=None, ddec=None):
+        """
+        Add a block of ephemeris points.
+
+        :param times: Time array
+        :param ra: numpy array of right ascensions, in degrees.
+        :param dec: numpy array of declinations, in degrees.
+        :param mag: numpy array of magnitudes.
+        :param dra: numpy array of RA rates, including cos(Dec), in arcsec/hour, NaN where not given.
+        :param ddec: numpy array of Dec rates in arcsec/hour, NaN where not given.
+        """
+        mjd = numpy.atleast_1d(times.utc.mjd)
+        points = numpy.empty(len(mjd), dtype=POINT_DTYPE)
+        points['mjd'] = mjd
+        points['ra_deg'] = ra
+        points['dec_deg'] = dec
+        points['mag'] = mag
+        points['dra'] = numpy.nan if dra is None else dra
+        points['ddec'] = numpy.nan if ddec is None else ddec
+        self._pending.append(points)
+
+    def _cdata_rows(self, points):
+        """
+        Format target locations as lines of the ephemeris listing.
+
+        :param points: numpy structured array with POINT_DTYPE
+        """
+        if len(points) == 0:
+            return ""
+        fields = self.fields
+        ra = points['ra_deg']
+        dec = points['dec_deg']
+        dates = Time(points['mjd'], format='mjd', scale='utc').iso
+        row = "".join("{{:{width}.{width}}}{colsep}".format(width=fields[fieldName]['attr']['width'],
+                                                            colsep=self.column_separator)
+                      for fieldName in self.field_names) + "\n"
+        return "".join([row.format(*values) for values in zip(dates, format_ra(ra), format_dec(dec))])
 
     def _append_cdata(self, coordinate):
         """
         Append an target location to the ephemeris listing.
         """
-        fields = self.fields
-        sra = coordinate.ra.to_string(units.hour, sep=':', precision=2, pad=True)
-        sdec = coordinate.dec.to_string(units.degree, sep=':', precision=1, alwayssign=True)
-        coord = SkyCoord(sra+" "+sdec, unit=(units.hour, units.degree))
-        sra = coord.ra.to_string(units.hour, sep=":", precision=2, pad=True)
-        sdec = coord.dec.to_string(units.degree, sep=":", precision=1, pad=True, alwayssign=True)
-        sdate = str(coordinate.obstime.replicate(format('iso')))
-        self.cdata.appendData(self._entry(sdate, fields["DATE_UTC"]['attr']['width'], colsep=self.column_separator))
-        self.cdata.appendData(self._entry(sra, fields["RA_J2000"]['attr']['width'], colsep=self.column_separator))
-        self.cdata.appendData(self._entry(sdec, fields["DEC_J2000"]["attr"]["width"], colsep=self.column_separator))
-        self.cdata.appendData("\n")
+        point = numpy.zeros(1, dtype=POINT_DTYPE)
+        point['mjd'] = coordinate.obstime.utc.mjd
+        point['ra_deg'] = coordinate.ra.degree
+        point['dec_deg'] = coordinate.dec.degree
+        self.cdata.appendData(self._cdata_rows(point))
+
+    def _cfht_et_header(self):
+        """
+        The CFHT ET document up to the start of the ephemeris listing, as written by minidom for the document built
+        by _init_cfht_et_file.
+        """
+        lines = ['<?xml version="1.0" ?>',
+                 '<!DOCTYPE ASTRO',
+                 "  SYSTEM 'http://vizier.u-strasbg.fr/xml/astrores.dtd'>",
+                 '  <ASTRO ID="v0.8" xmlns:ASTRO="http://vizier.u-strasbg.fr/doc/astrores.htx">',
+                 '    <TABLE ID="Table">']
+        nodes = dict(self.nodes)
+        nodes["TITLE"] += " target {}".format(self.name)
+        for key in sorted(nodes):
+            lines.append('      <{key}>{value}</{key}>'.format(key=key, value=_escape(nodes[key])))
+        lines.append('      <!--Definition of each field-->')
+        for fieldName in self.field_names:
+            attributes = dict(self.fields[fieldName]['attr'], name=fieldName)
+            lines.append('      <FIELD {}>'.format(" ".join('{}="{}"'.format(key, _escape(attributes[key]))
+                                                            for key in sorted(attributes))))
+            lines.append('        <DESCRIPTION>{}</DESCRIPTION>'.format(
+                _escape(self.fields[fieldName]['DESCRIPTION'])))
+            lines.append('      </FIELD>')
+        header_lines = self._cdata_header(colsep=self.column_separator)
+        lines.extend(['      <!--Data table-->',
+                      '      <DATA>',
+                      '        <CSV colsep="{}" headlines="{}">'.format(_escape(self.column_separator),
+                                                                          len(header_lines)),
+                      '<![CDATA[',
+                      ])
+        lines.extend(header_lines)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _cfht_et_footer():
+        return "]]>        </CSV>\n      </DATA>\n    </TABLE>\n  </ASTRO>\n"
+
+    @staticmethod
+    def _cfht_api_points(points, item_separator=', ', key_separator=': '):
+        """
+        Format ephemeris points as the members of the CFHT API ephemeris_points array.
+
+        The points are formatted with a single % operation on a template repeated for every point.
+
+        :param points: numpy structured array with POINT_DTYPE
+        """
+        if len(points) == 0:
+            return ""
+        point = ('{"coordinate"' + key_separator + '{"dec"' + key_separator + '"%.4f"' + item_separator +
+                 '"ra"' + key_separator + '"%.4f"}' + item_separator +
+                 '"epoch_millis"' + key_separator + '"%.5f"' + item_separator +
+                 '"mag"' + key_separator + '%s}')
+        values = numpy.empty((len(points), 4), dtype=object)
+        values[:, 0] = points['dec_deg']
+        values[:, 1] = points['ra_deg']
+        values[:, 2] = points['mjd']
+        # json spells the magnitudes exactly as json.dump would, NaN included.
+        values[:, 3] = json.dumps(points['mag'].tolist(), separators=(',', ':'))[1:-1].split(',')
+        return item_separator.join([point] * len(points)) % tuple(values.ravel().tolist())
 
     def cfht_api_writer(self, f_handle):
-        ephemeris_points = []
-        for coordinate in self.coordinates:
-            epoch_millis = "{:.5f}".format(coordinate.obstime.mjd)
-            this_coordinate = {"ra": "{:.4f}".format(float(coordinate.ra.degree)),
-                               "dec": "{:.4f}".format(float(coordinate.dec.degree))}
-            ephemeris_points.append({"epoch_millis": epoch_millis,
-                                     "mag": coordinate.mag,
-                                     "coordinate": this_coordinate})
-        target = {"identifier": {"client_token": "{}-{}".format(self.runid, self.name)},
-                  "name": self.name,
-                  "moving_target": {"ephemeris_points": ephemeris_points}}
-        json.dump(target, f_handle)
-        return
+        """
+        Write the CFHT API target description, the ephemeris points are formatted and written a block at a time.
+        """
+        points = self.points
+        item_separator, key_separator = self.compact and (',', ':') or (', ', ': ')
+        # keys are in the order json.dump wrote the equivalent dictionaries.
+        f_handle.write('{"identifier"' + key_separator + '{"client_token"' + key_separator +
+                       json.dumps("{}-{}".format(self.runid, self.name)) + '}' + item_separator +
+                       '"name"' + key_separator + json.dumps(self.name) + item_separator +
+                       '"moving_target"' + key_separator + '{"ephemeris_points"' + key_separator + '[')
+        for start in range(0, len(points), ROWS_PER_WRITE):
+            if start > 0:
+                f_handle.write(item_separator)
+            f_handle.write(self._cfht_api_points(points[start:start + ROWS_PER_WRITE], item_separator, key_separator))
+        f_handle.write(']}}')
+
+    def rates(self):
+        """
+        The rates of motion at each point, in arcsec/hour with the RA rate including cos(Dec), as in Horizons.
+
+        Where the points were added without rates they are estimated by finite differences of the positions.
+
+        :return: (dra, ddec) numpy arrays
+        """
+        points = self.points
+        dra = points['dra'].copy()
+        ddec = points['ddec'].copy()
+        missing = ~(numpy.isfinite(dra) & numpy.isfinite(ddec))
+        if missing.any() and len(points) > 1:
+            hours = (points['mjd'] - points['mjd'][0]) * 24.0
+            ra = numpy.degrees(numpy.unwrap(numpy.radians(points['ra_deg'])))
+            dra[missing] = (numpy.gradient(ra, hours) * 3600.0 * numpy.cos(numpy.radians(points['dec_deg'])))[missing]
+            ddec[missing] = (numpy.gradient(points['dec_deg'], hours) * 3600.0)[missing]
+        return dra, ddec
+
+    @staticmethod
+    def _gemini_rows(points, dra, ddec):
+        """
+        Format ephemeris points as lines of a Horizons style listing, with a single % operation for all the lines.
+        """
+        if len(points) == 0:
+            return ""
+        # whole milliseconds since the MJD epoch, so the minutes shown are not truncated by rounding errors.
+        dates = numpy.datetime64('1858-11-17', 'ms') + numpy.round(points['mjd'] * 86400000.0).astype('i8')
+        months = dates.astype('M8[M]')
+        days = dates.astype('M8[D]')
+        minutes = (dates - days).astype('m8[m]').astype('i8')
+        values = numpy.empty((len(points), 10), dtype=object)
+        values[:, 0] = months.astype('M8[Y]').astype('i8') + 1970
+        values[:, 1] = numpy.array(MONTH_NAMES)[months.astype('i8') % 12]
+        values[:, 2] = (days - months).astype('i8') + 1
+        values[:, 3] = minutes // 60
+        values[:, 4] = minutes % 60
+        values[:, 5] = points['mjd'] + MJD_ZERO_POINT
+        # Horizons shows the Dec seconds to 3 places, truncated from the 4 used for RA.
+        values[:, 6] = format_ra(points['ra_deg'], precision=4, sep=' ')
+        values[:, 7] = [dec[:-1] for dec in format_dec(points['dec_deg'], precision=4, sep=' ')]
+        values[:, 8] = dra
+        values[:, 9] = ddec
+        row = " %04d-%s-%02d %02d:%02d %17.9f    %s %s %+8.5f %+8.5f\n"
+        return (row * len(points)) % tuple(values.ravel().tolist())
 
     def gemini_writer(self, f_handle):
         """
@@ -181,47 +427,84 @@ class EphemTarget(object):
         #123456789012345678901234567890123456789012345678901234567890123456789012345678901234567890
         #' 2019-Jan-30 00:00     01 46 56.46 +10 28 54.9 01 47 56.17 +10 34 27.6    3.520
 
-        for coordinate in self.coordinates:
-            date = coordinate.obstime.datetime.strftime('%Y-%b-%d %H:%M')[:17]
-            f_handle.write(" {:16} {:17.9f}    {:27} {:+8.5f} {:+8.5f}\n".format(date,
-                                                     coordinate.obstime.jd,
-                                                     coordinate.to_string('hmsdms',
-                                                                          sep=' ',
-                                                                          precision=4,
-                                                                          pad=True)[:27],
-                                                     float(coordinate.dra),
-                                                     float(coordinate.ddec)),
-                           )
+        points = self.points
+        dra, ddec = self.rates()
+        for start in range(0, len(points), ROWS_PER_WRITE):
+            stop = start + ROWS_PER_WRITE
+            f_handle.write(self._gemini_rows(points[start:stop], dra[start:stop], ddec[start:stop]))
         f_handle.write(GEMINI_FOOTER)
         return
 
     def cfht_writer(self, f_handle):
-        self._init_cfht_et_file()
-        print len(self.coordinates)
-        for coordinate in self.coordinates:
-            self._append_cdata(coordinate)
-        self.doc.writexml(f_handle, indent="  ", addindent="  ", newl='\n')
-
-    def writer(self, f_handle):
-            if self.format == 'CFHT ET':
+        """
+        Write the CFHT ET document, the ephemeris listing is formatted and written a block of rows at a time.
+        """
+        points = self.points
+        f_handle.write(self._cfht_et_header())
+        for start in range(0, len(points), ROWS_PER_WRITE):
+            f_handle.write(self._cdata_rows(points[start:start + ROWS_PER_WRITE]))
+        f_handle.write(self._cfht_et_footer())
+
+    @property
+    def formats(self):
+        """
+        The list of formats save writes, the format given when the target was created may be one format or a list.
+        """
+        if isinstance(self.format, basestring):
+            return [self.format]
+        return list(self.format)
+
+    def writer(self, f_handle, ephem_format=None):
+            if ephem_format is None:
+                ephem_format = self.format
+            if ephem_format == 'CFHT ET':
                 self.cfht_writer(f_handle)
-            if self.format == "CFHT API":
+            elif ephem_format == "CFHT API":
                 self.cfht_api_writer(f_handle)
-            elif self.format == 'GEMINI ET':
+            elif ephem_format == 'GEMINI ET':
                 self.gemini_writer(f_handle)
             else:
                 raise ValueError("unkown ET Format")
 
+    def filename(self, ephem_format=None):
+        if ephem_format is None:
+            ephem_format = self.format
+        if ephem_format == 'CFHT ET':
+            return "ET_"+self.name+".xml"
+        elif ephem_format == 'GEMINI ET':
+            return self.name+".eph"
+        return self.name+".txt"
+
+    def _save(self, filename, ephem_format):
+        with open(filename, 'w') as f_handle:
+            self.writer(f_handle, ephem_format)
+        return filename
+
     def save(self, filename=None):
-        if filename is None:
-            if self.format == 'CFHT ET':
-               filename = "ET_"+self.name+".xml"
-            elif self.format == 'GEMINI ET':
-               filename = self.name+".eph"
-            else:
-               filename = self.name+".txt"
-        with file(filename, 'w') as f_handle:
-            self.writer(f_handle)
+        """
+        Write the ephemeris in each of the formats of the target, to the standard file name of each format.
+
+        When there is more than one format the files are written at the same time, one thread per format.
+
+        :param filename: name of the file to write, only allowed when there is a single format.
+        :return: list of the files written.
+        """
+        formats = self.formats
+        for ephem_format in formats:
+            if ephem_format not in EPHEM_FORMATS:
+                raise ValueError("unkown ET Format {}".format(ephem_format))
+        if filename is not None and len(formats) > 1:
+            raise ValueError("Can not write {} formats to the one file {}".format(len(formats), filename))
+        if len(formats) == 1:
+            return [self._save(filename is None and self.filename(formats[0]) or filename, formats[0])]
+        # gather any pending points before the writers share them.
+        self.points
+        pool = ThreadPool(len(formats))
+        try:
+            return pool.map(lambda ephem_format: self._save(self.filename(ephem_format), ephem_format), formats)
+        finally:
+            pool.close()
+            pool.join()
 
 
 GEMINI_HEADER="""*******************************************************************************
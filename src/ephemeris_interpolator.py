@@ -0,0 +1,195 @@
+"""
+Interpolate a Horizons ephemeris, fetched once on a coarse grid, to arbitrary times.
+
+Positions are interpolated with cubic Hermite polynomials that match both the position and the rate of motion
+Horizons reports at each grid point, so the error falls as the fourth power of the grid spacing and a grid of an
+hour, or even a day for a slow moving TNO, reproduces a 5 minute ephemeris to well below the precision of the ET
+files.  A grid of a day or longer cannot follow the topocentric diurnal parallax (about 0.2 arcsec for a TNO at
+40 au), which is also invisible to the error estimate.
+"""
+import numpy
+from astropy import units
+
+ARCSEC_PER_DEGREE = 3600.0
+HOURS_PER_DAY = 24.0
+
+# Largest offset allowed between the track and a straight line between adaptively sampled points.
+DEFAULT_TOLERANCE = 0.1 * units.arcsec
+
+
+class EphemerisInterpolator(object):
+    """
+    Evaluate RA, Dec and magnitude from a tabulated ephemeris at any time inside the table.
+    """
+
+    def __init__(self, ephemeris):
+        """
+        :param ephemeris: numpy structured array with jd, ra, dec, mag, ra_rate and dec_rate columns, see
+        horizons_cache.EPHEMERIS_DTYPE.  Rates are in arcsec/hour with RA rates including the cos(Dec) term, as
+        returned by Horizons.  Where the rates are missing they are estimated from the positions.
+        """
+        if len(ephemeris) < 2:
+            raise ValueError("Need at least two ephemeris points to interpolate.")
+        self.jd0 = ephemeris['jd'][0]
+        self.t = ephemeris['jd'] - self.jd0
+        self.ra = numpy.degrees(numpy.unwrap(numpy.radians(ephemeris['ra'])))
+        self.dec = numpy.array(ephemeris['dec'], dtype='f8')
+        self.mag = numpy.array(ephemeris['mag'], dtype='f8')
+        # Horizons rates in arcsec/hour to degrees/day.
+        scale = HOURS_PER_DAY / ARCSEC_PER_DEGREE
+        self.ra_rate = ephemeris['ra_rate'] * scale / numpy.cos(numpy.radians(self.dec))
+        self.dec_rate = ephemeris['dec_rate'] * scale
+        if not numpy.all(numpy.isfinite(self.ra_rate)):
+            self.ra_rate = numpy.gradient(self.ra, self.t)
+        if not numpy.all(numpy.isfinite(self.dec_rate)):
+            self.dec_rate = numpy.gradient(self.dec, self.t)
+        self._max_error = None
+
+    @property
+    def start(self):
+        return self.jd0 + self.t[0]
+
+    @property
+    def stop(self):
+        return self.jd0 + self.t[-1]
+
+    @staticmethod
+    def _hermite(nodes, values, rates, x):
+        idx = numpy.clip(numpy.searchsorted(nodes, x, side='right') - 1, 0, len(nodes) - 2)
+        h = nodes[idx + 1] - nodes[idx]
+        s = (x - nodes[idx]) / h
+        s2 = s * s
+        s3 = s2 * s
+        return ((2 * s3 - 3 * s2 + 1) * values[idx] +
+                (s3 - 2 * s2 + s) * h * rates[idx] +
+                (-2 * s3 + 3 * s2) * values[idx + 1] +
+                (s3 - s2) * h * rates[idx + 1])
+
+    @staticmethod
+    def _hermite_rate(nodes, values, rates, x):
+        idx = numpy.clip(numpy.searchsorted(nodes, x, side='right') - 1, 0, len(nodes) - 2)
+        h = nodes[idx + 1] - nodes[idx]
+        s = (x - nodes[idx]) / h
+        s2 = s * s
+        return ((6 * s2 - 6 * s) * (values[idx] - values[idx + 1]) / h +
+                (3 * s2 - 4 * s + 1) * rates[idx] +
+                (3 * s2 - 2 * s) * rates[idx + 1])
+
+    def predict(self, times):
+        """
+        Compute the position and magnitude at each time.
+
+        :param times: Time array, inside the span of the ephemeris.
+        :return: (ra, dec, mag) numpy arrays, ra and dec in degrees.
+        """
+        x = numpy.atleast_1d(times.utc.jd) - self.jd0
+        ra = self._hermite(self.t, self.ra, self.ra_rate, x) % 360.0
+        dec = self._hermite(self.t, self.dec, self.dec_rate, x)
+        mag = numpy.interp(x, self.t, self.mag)
+        return ra, dec, mag
+
+    def rates(self, times):
+        """
+        Compute the rate of motion at each time.
+
+        :param times: Time array, inside the span of the ephemeris.
+        :return: (ra_rate, dec_rate) numpy arrays in arcsec/hour, the RA rate including the cos(Dec) term as in
+        Horizons.
+        """
+        x = numpy.atleast_1d(times.utc.jd) - self.jd0
+        dec = self._hermite(self.t, self.dec, self.dec_rate, x)
+        scale = ARCSEC_PER_DEGREE / HOURS_PER_DAY
+        ra_rate = self._hermite_rate(self.t, self.ra, self.ra_rate, x) * numpy.cos(numpy.radians(dec)) * scale
+        dec_rate = self._hermite_rate(self.t, self.dec, self.dec_rate, x) * scale
+        return ra_rate, dec_rate
+
+    @property
+    def max_error(self):
+        """
+        An estimate of the largest interpolation error over the ephemeris.
+
+        The ephemeris is interpolated from every second point onto the points left out, and as the error scales as
+        the fourth power of the spacing that error is reduced by a factor of 16.
+
+        :return: Quantity, angle.
+        """
+        if self._max_error is None:
+            if len(self.t) < 3:
+                self._max_error = 0 * units.arcsec
+                return self._max_error
+            even = slice(0, None, 2)
+            x = self.t[1::2]
+            if x[-1] > self.t[even][-1]:
+                x = x[:-1]
+            odd = slice(1, 2 * len(x), 2)
+            ra = self._hermite(self.t[even], self.ra[even], self.ra_rate[even], x)
+            dec = self._hermite(self.t[even], self.dec[even], self.dec_rate[even], x)
+            d_ra = (ra - self.ra[odd]) * numpy.cos(numpy.radians(self.dec[odd]))
+            d_dec = dec - self.dec[odd]
+            error = numpy.sqrt(d_ra ** 2 + d_dec ** 2).max() if len(x) > 0 else 0.0
+            self._max_error = (error / 16.0 * units.degree).to(units.arcsec)
+        return self._max_error
+
+
+def _chord_error(t, x, y, first, last):
+    """
+    Offset of each point from the straight line joining points first and last, and the index of the largest.
+    """
+    f = (t[first:last + 1] - t[first]) / (t[last] - t[first])
+    dx = x[first] + f * (x[last] - x[first]) - x[first:last + 1]
+    dy = y[first] + f * (y[last] - y[first]) - y[first:last + 1]
+    error = numpy.sqrt(dx ** 2 + dy ** 2)
+    worst = error.argmax()
+    return error[worst], first + worst
+
+
+def adaptive_indices(jd, ra, dec, windows, tolerance=DEFAULT_TOLERANCE):
+    """
+    Choose which points of a finely sampled track to keep so that linear interpolation between the points kept
+    stays within tolerance of the track.
+
+    Every window keeps its first and last point.  In between, points are placed a distance apart set by the
+    curvature of the track, sqrt(8 tolerance / acceleration), so fast or curving targets keep more points than slow
+    ones.  Each resulting segment is then checked against every fine point it spans and split at its worst point
+    until all are within tolerance.
+
+    :param jd: numpy array of julian dates of the fine grid.
+    :param ra: numpy array of right ascensions, in degrees.
+    :param dec: numpy array of declinations, in degrees.
+    :param windows: list of (first, last) index pairs, eg. from visibility.windows.
+    :param tolerance: Quantity, angle.
+    :return: numpy array of the indices to keep, in order.
+    """
+    tolerance = tolerance.to(units.degree).value
+    keep = []
+    for first, last in windows:
+        if last - first < 2:
+            keep.extend(range(first, last + 1))
+            continue
+        t = jd[first:last + 1] - jd[first]
+        # offsets on the sky, in degrees, relative to the start of the window.
+        x = (numpy.degrees(numpy.unwrap(numpy.radians(ra[first:last + 1]))) - ra[first]) * numpy.cos(
+            numpy.radians(dec[first:last + 1]))
+        y = dec[first:last + 1] - dec[first]
+        acceleration = numpy.hypot(numpy.gradient(numpy.gradient(x, t), t), numpy.gradient(numpy.gradient(y, t), t))
+        with numpy.errstate(divide='ignore'):
+            spacing = numpy.sqrt(8 * tolerance / acceleration)
+
+        points = [0]
+        while points[-1] < len(t) - 1:
+            idx = points[-1]
+            n_steps = numpy.searchsorted(t, t[idx] + spacing[idx], side='right') - 1 - idx
+            points.append(min(idx + max(n_steps, 1), len(t) - 1))
+
+        segments = list(zip(points[:-1], points[1:]))
+        points = set(points)
+        while segments:
+            start, stop = segments.pop()
+            if stop - start < 2:
+                continue
+            error, worst = _chord_error(t, x, y, start, stop)
+            if error > tolerance:
+                points.add(worst)
+                segments.extend([(start, worst), (worst, stop)])
+        keep.extend(first + idx for idx in sorted(points))
+    return numpy.array(keep, dtype=int)
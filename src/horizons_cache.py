@@ -0,0 +1,404 @@
+"""
+A persistent on-disk cache of JPL/Horizons ephemerides.
+
+Each query is content addressed on (target name, start, stop, step, center) and the ephemeris is stored as a
+compact numpy structured array, one .npy file per query.  Entries expire after a configurable time-to-live and
+the least recently used entries are evicted once the cache grows past a size limit.
+
+Several targets on the same time grid are fetched together with HorizonsCache.fetch_many: cached ephemerides are
+used without a request and the rest are sent in groups of batch_size to the cache's batch_query, with a group that
+fails fetched again one target at a time.  The Horizons batch interface takes a single COMMAND per request, so for
+Horizons each group is one target and the groups run concurrently; a batch_query that can answer for many targets at
+once, such as a local orbit propagator, gets them in one call.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import numpy
+from astropy import units
+from astropy.time import Time
+from mp_ephem import horizons
+import horizons_client
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'cfht_mp_tracking', 'horizons')
+DEFAULT_TTL = 7 * units.day
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+DEFAULT_CENTER = '568'
+
+# Columns kept from the Horizons ephemeris table, rates are in arcsec/hour.
+EPHEMERIS_DTYPE = numpy.dtype([('jd', 'f8'),
+                               ('ra', 'f8'),
+                               ('dec', 'f8'),
+                               ('mag', 'f8'),
+                               ('ra_rate', 'f8'),
+                               ('dec_rate', 'f8')])
+HORIZONS_COLUMNS = {'ra': 'R.A._(ICRF/J2000.0)',
+                    'dec': 'DEC_(ICRF/J2000.0)',
+                    'mag': 'APmag',
+                    'ra_rate': 'dRA*cosD',
+                    'dec_rate': 'd(DEC)/dt'}
+
+
+def ephemeris_array(body):
+    """
+    Pull the columns we use out of a horizons.Body ephemeris table.
+
+    :param body: horizons.Body (or a stand-in with the same ephemeris table)
+    :return: numpy structured array with EPHEMERIS_DTYPE
+    """
+    table = body.ephemeris
+    ephemeris = numpy.zeros(len(table), dtype=EPHEMERIS_DTYPE)
+    ephemeris['jd'] = table['Time'].jd
+    for name, column in HORIZONS_COLUMNS.items():
+        if column not in table.colnames:
+            ephemeris[name] = numpy.nan
+            continue
+        values = table[column]
+        if hasattr(values, 'filled'):
+            values = values.filled(numpy.nan)
+        ephemeris[name] = values
+    return ephemeris
+
+
+class FileBody(horizons.Body):
+    """
+    A stand-in for horizons.Body that reads saved Horizons batch output from a local directory.
+
+    The file for a target is its name, with spaces replaced by underscores, and a .txt extension.  It holds the
+    text returned by the Horizons batch interface, so the ephemeris is parsed exactly as for a live query.
+    """
+
+    def __init__(self, name, start_time=None, stop_time=None, step_size=None, center=None, directory='.'):
+        super(FileBody, self).__init__(name, start_time=start_time, stop_time=stop_time, step_size=step_size,
+                                       center=center)
+        self.directory = directory
+
+    @property
+    def filename(self):
+        return os.path.join(self.directory, "{}.txt".format(self.name.replace(" ", "_")))
+
+    @property
+    def data(self):
+        if self._data is None:
+            logging.debug("Reading Horizons result from {}".format(self.filename))
+            with open(self.filename, 'rb') as f_handle:
+                self._data = f_handle.read().splitlines()
+        return self._data
+
+
+class HorizonsCache(object):
+    """
+    Fetch ephemerides through a directory of cached Horizons results.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES,
+                 enabled=True, refresh=False, body_class=None, max_requests=horizons_client.DEFAULT_MAX_REQUESTS,
+                 batch_query=None, batch_size=1):
+        """
+        :param directory: where the cached ephemerides are stored.
+        :param ttl: Quantity, age after which a cached ephemeris is fetched again.
+        :param max_bytes: size the cache is trimmed back to, least recently used first.
+        :param enabled: when False every fetch goes to Horizons and nothing is stored.
+        :param refresh: when True every fetch goes to Horizons and the result replaces the cached one.
+        :param body_class: horizons.Body or a stand-in, such as FileBody, used for cache misses.  Defaults to
+        querying through a horizons_client.HorizonsClient.
+        :param max_requests: number of Horizons requests fetch_many has in flight at once.
+        :param batch_query: function(names, start_time, stop_time, step_size, center) returning a dictionary of the
+        ephemeris of each of names, used for cache misses in place of body_class.
+        :param batch_size: largest number of names given to batch_query at once, 1 when querying through body_class.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.refresh = refresh
+        if body_class is None:
+            body_class = horizons_client.HorizonsClient(max_requests=max_requests).body_class
+        self.body_class = body_class
+        self.max_requests = max_requests
+        self.batch_query = batch_query
+        self.batch_size = batch_query is not None and max(1, batch_size) or 1
+
+    @staticmethod
+    def key(name, start_time, stop_time, step_size, center=DEFAULT_CENTER):
+        """
+        The content address of a query.
+
+        :return: str hex digest
+        """
+        query = [str(name),
+                 "{:.6f}".format(Time(start_time).jd),
+                 "{:.6f}".format(Time(stop_time).jd),
+                 "{:.6f}".format(step_size.to(units.minute).value),
+                 str(center)]
+        return hashlib.sha1(json.dumps(query).encode('utf-8')).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, "{}.npy".format(key))
+
+    def get(self, key):
+        """
+        Look up a cached ephemeris.
+
+        :param key: from HorizonsCache.key
+        :return: numpy structured array, or None if there is no live entry.
+        """
+        filename = self.filename(key)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        now = time.time()
+        if now - stat.st_mtime > self.ttl.to(units.second).value:
+            logging.debug("Cached ephemeris {} has expired.".format(filename))
+            self._remove(filename)
+            return None
+        try:
+            ephemeris = numpy.load(filename)
+            # access time orders the entries for eviction, modification time is the age of the entry.
+            os.utime(filename, (now, stat.st_mtime))
+        except (IOError, OSError):
+            # evicted by another fetch since the stat.
+            return None
+        return ephemeris
+
+    def put(self, key, ephemeris):
+        """
+        Store an ephemeris and trim the cache back to max_bytes.
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        # write to a unique file and rename it into place, so concurrent fetches never see a partial entry.
+        handle, partial = tempfile.mkstemp(suffix='.part', dir=self.directory)
+        with os.fdopen(handle, 'wb') as f_handle:
+            numpy.save(f_handle, ephemeris)
+        os.rename(partial, self.filename(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, filename))
+        total = sum(entry[1] for entry in entries)
+        for atime, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logging.debug("Evicting {} from the Horizons cache.".format(filename))
+            self._remove(filename)
+            total -= size
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def clear(self):
+        """
+        Remove every cached ephemeris.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                self._remove(os.path.join(self.directory, name))
+
+    def query(self, names, start_time, stop_time, step_size, center=DEFAULT_CENTER):
+        """
+        Query the ephemerides of names, without the cache.
+
+        :param names: list of up to batch_size target designations.
+        :return: dictionary of numpy structured arrays with EPHEMERIS_DTYPE, by name.
+        """
+        if self.batch_query is not None:
+            return self.batch_query(names, start_time, stop_time, step_size, center)
+        ephemerides = {}
+        for name in names:
+            logging.debug("Fetching ephemeris for {} from Horizons.".format(name))
+            body = self.body_class(name, start_time=start_time, stop_time=stop_time, step_size=step_size,
+                                   center=center)
+            ephemerides[name] = ephemeris_array(body)
+        return ephemerides
+
+    def fetch(self, name, start_time, stop_time, step_size=None, center=DEFAULT_CENTER):
+        """
+        Get the ephemeris of name, from the cache if possible.
+
+        :param name: target designation, as understood by Horizons.
+        :param start_time: Time
+        :param stop_time: Time
+        :param step_size: Quantity, defaults to one day as for horizons.Body.
+        :param center: observatory code
+        :return: numpy structured array with EPHEMERIS_DTYPE
+        """
+        if step_size is None:
+            step_size = 1 * units.day
+        key = self.key(name, start_time, stop_time, step_size, center)
+        if self.enabled and not self.refresh:
+            ephemeris = self.get(key)
+            if ephemeris is not None:
+                logging.debug("Using cached ephemeris for {}".format(name))
+                return ephemeris
+        ephemeris = self.query([name], start_time, stop_time, step_size, center)[name]
+        if self.enabled:
+            self.put(key, ephemeris)
+        return ephemeris
+
+    def _batch_task(self, names, start_time, stop_time, step_size, center):
+        """
+        Query a group of names, falling back to one query per name if the group fails.
+
+        :return: list of (name, ephemeris, error)
+        """
+        try:
+            ephemerides = self.query(names, start_time, stop_time, step_size, center)
+        except Exception as ex:
+            if len(names) == 1:
+                logging.debug("Fetch of {} failed".format(names[0]), exc_info=True)
+                return [(names[0], None, "{}: {}".format(type(ex).__name__, ex))]
+            logging.warning("Fetch of {} targets together failed ({}), fetching them one at a time.".format(
+                len(names), ex))
+            results = []
+            for name in names:
+                results.extend(self._batch_task([name], start_time, stop_time, step_size, center))
+            return results
+        results = []
+        for name in names:
+            if name not in ephemerides:
+                results.append((name, None, "KeyError: no ephemeris returned for {}".format(name)))
+                continue
+            if self.enabled:
+                self.put(self.key(name, start_time, stop_time, step_size, center), ephemerides[name])
+            results.append((name, ephemerides[name], None))
+        return results
+
+    def fetch_many(self, names, start_time, stop_time, step_size=None, center=DEFAULT_CENTER, max_requests=None):
+        """
+        Get the ephemerides of several targets on the same time grid, in as few requests as possible.
+
+        Each name is fetched once, however often it is given, and cached ephemerides are returned straight away.  The
+        rest are queried in groups of batch_size, with up to max_requests groups in flight at once.  A target that can
+        not be fetched is reported with its error and does not stop the others.
+
+        :param names: list of target designations.
+        :param max_requests: number of requests in flight at once, defaults to the max_requests of the cache.
+        :return: iterator of (name, ephemeris, error) in the order the fetches finish, ephemeris is None and error a
+        message when the fetch failed.
+        """
+        if step_size is None:
+            step_size = 1 * units.day
+        if max_requests is None:
+            max_requests = self.max_requests
+        misses = []
+        for name in OrderedDict.fromkeys(names):
+            ephemeris = None
+            if self.enabled and not self.refresh:
+                ephemeris = self.get(self.key(name, start_time, stop_time, step_size, center))
+            if ephemeris is None:
+                misses.append(name)
+                continue
+            logging.debug("Using cached ephemeris for {}".format(name))
+            yield name, ephemeris, None
+        groups = [misses[idx:idx + self.batch_size] for idx in range(0, len(misses), self.batch_size)]
+        if max_requests <= 1 or len(groups) <= 1:
+            for group in groups:
+                for result in self._batch_task(group, start_time, stop_time, step_size, center):
+                    yield result
+            return
+        pool = ThreadPool(min(max_requests, len(groups)))
+        try:
+            for results in pool.imap_unordered(lambda group: self._batch_task(group, start_time, stop_time,
+                                                                              step_size, center), groups):
+                for result in results:
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch_batch(self, names, start_time, stop_time, step_size=None, center=DEFAULT_CENTER, max_requests=None):
+        """
+        Get the ephemerides of several targets on the same time grid, see fetch_many.
+
+        :return: OrderedDict of (ephemeris, error) by name, in the order of names.
+        """
+        results = dict((name, (ephemeris, error))
+                       for name, ephemeris, error in self.fetch_many(names, start_time, stop_time, step_size=step_size,
+                                                                     center=center, max_requests=max_requests))
+        return OrderedDict((name, results[name]) for name in names)
+
+
+def add_cache_arguments(parser):
+    """
+    Add the options that configure the Horizons cache to an argparse parser.
+    """
+    parser.add_argument('--no-cache', help="Always query Horizons and do not store the results.",
+                        action="store_true", default=False)
+    parser.add_argument('--refresh', help="Query Horizons again and replace any cached results.",
+                        action="store_true", default=False)
+    parser.add_argument('--cache-directory', help="Directory holding cached Horizons results.",
+                        default=DEFAULT_CACHE_DIRECTORY)
+    parser.add_argument('--cache-ttl', help="Days before a cached Horizons result is fetched again.",
+                        default=DEFAULT_TTL.to(units.day).value, type=float)
+    parser.add_argument('--cache-size', help="Size, in MB, the Horizons cache is trimmed back to.",
+                        default=DEFAULT_MAX_BYTES / 1024 ** 2, type=float)
+    parser.add_argument('--horizons-directory',
+                        help="Read saved Horizons results from this directory instead of querying the service.",
+                        default=None)
+    parser.add_argument('--horizons-url', help="Horizons batch interface to query.",
+                        default=horizons_client.HORIZONS_URL)
+    parser.add_argument('--horizons-rate', help="Largest number of Horizons requests sent per second.",
+                        default=horizons_client.DEFAULT_RATE, type=float)
+    parser.add_argument('--max-requests', help="Maximum number of concurrent Horizons requests.",
+                        default=horizons_client.DEFAULT_MAX_REQUESTS, type=int)
+    parser.add_argument('--source', help="Where ephemerides come from: Horizons, or the orbits in an MPCORB file "
+                                         "propagated locally, which is quicker but less precise.",
+                        choices=['horizons', 'mpcorb'], default='horizons')
+    parser.add_argument('--mpcorb', help="MPCORB.DAT format file of the orbits used with --source mpcorb.",
+                        default='MPCORB.DAT')
+
+
+def cache_from_args(args):
+    """
+    Build the HorizonsCache described by the options from add_cache_arguments.
+
+    Propagated ephemerides are quicker to compute again than to cache, and must not mix with the cached Horizons ones,
+    so with --source mpcorb nothing is cached.
+    """
+    if args.source == 'mpcorb':
+        import mpcorb_ephemeris
+        return HorizonsCache(enabled=False,
+                             batch_query=mpcorb_ephemeris.MPCORBSource(args.mpcorb).query,
+                             batch_size=mpcorb_ephemeris.DEFAULT_BATCH_SIZE,
+                             max_requests=1)
+    if args.horizons_directory is not None:
+        body_class = functools.partial(FileBody, directory=args.horizons_directory)
+    else:
+        body_class = horizons_client.HorizonsClient(url=args.horizons_url, rate=args.horizons_rate,
+                                                    max_requests=args.max_requests).body_class
+    return HorizonsCache(directory=args.cache_directory,
+                         ttl=args.cache_ttl * units.day,
+                         max_bytes=int(args.cache_size * 1024 ** 2),
+                         enabled=not args.no_cache,
+                         refresh=args.refresh,
+                         body_class=body_class,
+                         max_requests=args.max_requests)
@@ -0,0 +1,163 @@
+"""
+A client for the JPL/Horizons batch interface that is safe to share between threads.
+
+Requests go over one pooled requests.Session, pass through a token bucket so that no more than a set rate of
+requests is sent however many threads are fetching, and are retried with exponential backoff when the service is
+unreachable or throttles us.  This replaces reloading mp_ephem.horizons to get a fresh connection for each target.
+"""
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from mp_ephem import horizons
+
+HORIZONS_URL = '{}://{}/{}'.format(horizons.Query.PROTOCOL, horizons.Query.SERVER, horizons.Query.END_POINT)
+
+# Horizons throttles clients that send too many requests at once.
+DEFAULT_MAX_REQUESTS = 4
+# requests per second, and the number that may be sent at once after a pause.
+DEFAULT_RATE = 2.0
+DEFAULT_BURST = 4
+DEFAULT_RETRIES = 4
+# seconds before the first retry, doubled for each retry after that.
+DEFAULT_BACKOFF = 2.0
+# seconds to wait for the service to connect and to send data.
+DEFAULT_TIMEOUT = 120.0
+# responses that mean the service is busy or throttling us, rather than that the query is bad.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket(object):
+    """
+    Limit the rate of an operation across threads: each operation takes a token, tokens are added at rate per second
+    up to capacity.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_BURST):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+
+        :return: seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class HorizonsClient(object):
+    """
+    Send queries to the Horizons batch interface through a shared connection pool and rate limit.
+    """
+
+    def __init__(self, url=HORIZONS_URL, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_requests=DEFAULT_MAX_REQUESTS,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT, session=None):
+        """
+        :param url: the Horizons batch interface, or a stand-in such as local_server.HorizonsHandler.
+        :param rate: largest number of requests sent per second.
+        :param burst: number of requests that may be sent at once after a pause.
+        :param max_requests: number of pooled connections, the most requests expected to be in flight at once.
+        :param retries: number of times a failed request is retried.
+        :param backoff: seconds before the first retry, doubled for each retry after that.
+        :param timeout: seconds to wait for the service before the request is retried.
+        :param session: requests.Session to send the queries through, one with a connection pool is made if not given.
+        """
+        self.url = url
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_requests)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def get(self, params):
+        """
+        Send a query to Horizons.
+
+        :param params: dictionary of the query parameters, see horizons.Query.params
+        :return: list of the lines of the response, as bytes.
+        """
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            delay = self.backoff * 2 ** attempt
+            try:
+                response = self.session.get(self.url, params=params, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return response.content.splitlines()
+                error = "HTTP {}".format(response.status_code)
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                error = str(ex)
+            if attempt >= self.retries:
+                raise IOError("Horizons query for {} failed after {} attempts: {}".format(params.get('COMMAND'),
+                                                                                          attempt + 1, error))
+            logging.warning("Horizons query for {} failed ({}), retrying in {:.0f}s.".format(params.get('COMMAND'),
+                                                                                            error, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def body_class(self, name, start_time=None, stop_time=None, step_size=None, center=None):
+        """
+        Make a ClientBody that queries through this client, used as the body_class of a horizons_cache.HorizonsCache.
+        """
+        return ClientBody(name, start_time=start_time, stop_time=stop_time, step_size=step_size, center=center,
+                          client=self)
+
+
+class ClientQuery(horizons.Query):
+    """
+    A horizons.Query that leaves horizons.Query.default_quantities alone.
+
+    horizons.Query extends the list of quantities it is given with the default quantities, and is given the default
+    list itself, which doubles in length with every Query made.  Reloading the horizons module for every target used
+    to reset it.
+    """
+
+    quantities = property(horizons.Query.quantities.fget)
+
+    @quantities.setter
+    def quantities(self, quantities=None):
+        horizons.Query.quantities.fset(self, list(quantities or []))
+
+
+class ClientBody(horizons.Body):
+    """
+    A horizons.Body that sends its query through a HorizonsClient.
+    """
+
+    def __init__(self, name, start_time=None, stop_time=None, step_size=None, center=None, client=None):
+        super(ClientBody, self).__init__(name, start_time=start_time, stop_time=stop_time, step_size=step_size,
+                                         center=center)
+        self.client = client is not None and client or HorizonsClient()
+
+    @property
+    def data(self):
+        if self._data is None:
+            query = ClientQuery(self.name, self._start_time, self._stop_time, self.step_size)
+            query.center = self._center
+            self._data = self.client.get(query.params)
+        return self._data
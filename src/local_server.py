@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+A local HTTP stand-in for the web services the tracking tools use, for trying them out without network access.
+
+The server serves the files in a directory, eg. saved copies of the RECON lists, with ETag and Last-Modified headers
+and answers conditional requests with 304 Not Modified, as the RECON server does.  Point the tools at it with their
+--service-url option.  With --horizons it also answers Horizons batch queries from saved Horizons results in the same
+directory, point the tools at it with --horizons-url.
+"""
+import argparse
+import email.utils
+import hashlib
+import logging
+import os
+import threading
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+DEFAULT_PORT = 8000
+HORIZONS_END_POINT = 'horizons_batch.cgi'
+HORIZONS_NO_MATCH = """*******************************************************************************
+ JPL/HORIZONS stand-in
+ No matches found.
+*******************************************************************************
+"""
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """
+    Serve the files in the server's directory, honouring If-None-Match and If-Modified-Since.
+    """
+
+    def do_GET(self):
+        path = urllib.unquote(urlparse.urlparse(self.path).path)
+        filename = os.path.join(self.server.directory, *[part for part in path.split('/') if part not in ('', '..')])
+        try:
+            with open(filename, 'rb') as f_handle:
+                content = f_handle.read()
+            mtime = os.stat(filename).st_mtime
+        except (IOError, OSError):
+            self.respond(404)
+            return
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        last_modified = email.utils.formatdate(int(mtime), usegmt=True)
+        headers = {'ETag': etag, 'Last-Modified': last_modified}
+        if_none_match = self.headers.getheader('If-None-Match')
+        if_modified_since = self.headers.getheader('If-Modified-Since')
+        if if_none_match is not None:
+            not_modified = etag in [tag.strip() for tag in if_none_match.split(',')]
+        elif if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            not_modified = since is not None and int(mtime) <= email.utils.mktime_tz(since)
+        else:
+            not_modified = False
+        if not_modified:
+            self.respond(304, headers=headers)
+            return
+        content_type = filename.endswith('.csv') and 'text/csv' or 'text/html'
+        self.respond(200, content, content_type=content_type, headers=headers)
+
+    def respond(self, status, content='', content_type='text/plain', headers=None):
+        """
+        Send a complete response and record it in the server's log of requests.
+        """
+        self.server.record(self.path, status)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if status != 304:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug("{} {}".format(self.address_string(), format % args))
+
+
+class HorizonsHandler(FixtureHandler):
+    """
+    Answer Horizons batch queries from saved results, as horizons_cache.FileBody reads them: the file for a target is
+    its COMMAND, with spaces replaced by underscores, and a .txt extension.  Targets without a file get a reply with no
+    ephemeris in it, as Horizons sends for a designation it does not know.  Other paths are served as files.
+
+    While the server's throttle count is above zero queries are answered with 503 Service Unavailable, as Horizons does
+    when it is busy.
+    """
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if not url.path.endswith(HORIZONS_END_POINT):
+            FixtureHandler.do_GET(self)
+            return
+        if self.server.take_throttle():
+            self.respond(503, "Busy, try again later.\n", headers={'Retry-After': '0'})
+            return
+        command = urlparse.parse_qs(url.query).get('COMMAND', [''])[0].strip("'")
+        filename = os.path.join(self.server.directory, "{}.txt".format(command.replace(" ", "_")))
+        try:
+            with open(filename, 'rb') as f_handle:
+                content = f_handle.read()
+        except (IOError, OSError):
+            content = HORIZONS_NO_MATCH
+        self.respond(200, content)
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    """
+    A threaded HTTP server on localhost, started in a background thread.
+
+    The (path, status) of every request is kept in requests, so a client's use of the server can be checked.  Set
+    throttle to the number of upcoming Horizons queries that should be refused, see HorizonsHandler.
+    """
+    daemon_threads = True
+
+    def __init__(self, directory, port=0, handler_class=FixtureHandler):
+        """
+        :param directory: directory of the files served.
+        :param port: port to listen on, any free port if 0.
+        :param handler_class: request handler, FixtureHandler or a subclass of it such as HorizonsHandler.
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), handler_class)
+        self.directory = directory
+        self.requests = []
+        self.throttle = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def record(self, path, status):
+        with self._lock:
+            self.requests.append((path, status))
+
+    def take_throttle(self):
+        """
+        Count down the throttle.
+
+        :return: True if the request should be refused.
+        """
+        with self._lock:
+            if self.throttle <= 0:
+                return False
+            self.throttle -= 1
+            return True
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory', help="Directory of the files to serve.")
+    parser.add_argument('--port', help="Port to listen on.", default=DEFAULT_PORT, type=int)
+    parser.add_argument('--horizons', help="Also answer Horizons batch queries from the saved results in directory.",
+                        action="store_true", default=False)
+    parser.add_argument('--verbose', help="Verbose message reporting.", action="store_true", default=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.verbose and logging.DEBUG or logging.ERROR)
+    server = LocalServer(args.directory, port=args.port,
+                         handler_class=args.horizons and HorizonsHandler or FixtureHandler)
+    print "Serving {} at {}".format(args.directory, server.url)
+    if args.horizons:
+        print "Horizons queries at {}/{}".format(server.url, HORIZONS_END_POINT)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
-from ossos.ephem_target import EphemTarget
+from ephem_target import EphemTarget, EPHEM_FORMATS
 from astropy.time import Time
 from astropy import units
-from mp_ephem import horizons
 import ephem
-import math
-from copy import deepcopy
+import numpy
 import argparse
+import logging
+import sys
+from collections import OrderedDict
+from multiprocessing import Pool
+import visibility
+import horizons_cache
+import horizons_client
+from ephemeris_interpolator import EphemerisInterpolator, adaptive_indices
 
 _cfht = ephem.Observer()
 _cfht.lat = 0.344
@@ -15,75 +21,136 @@ _cfht.lon = -2.707
 _cfht.elevation = 4100
 _cfht.date = '2018/03/28 20:00:00'
 
+# Horizons throttles clients that send too many requests at once.
+DEFAULT_MAX_REQUESTS = horizons_client.DEFAULT_MAX_REQUESTS
+
+# Warn when interpolating the Horizons grid could move a position by more than this.
+MAX_INTERPOLATION_ERROR = 0.1 * units.arcsec
+
+
+def fetch_ephemeris(target_name, start_time, stop_time, step_size, cache=None):
+    """
+    Retrieve the Horizons ephemeris of target_name, this is the I/O bound part of building an ephemeris file.
+
+    step_size is the spacing of the Horizons grid, which can be much coarser than the ephemeris file written.
+
+    :return: numpy structured array, see horizons_cache.EPHEMERIS_DTYPE
+    """
+    if cache is None:
+        cache = horizons_cache.HorizonsCache()
+    return cache.fetch(target_name.replace("_", " "), start_time, stop_time, step_size=step_size, center='568')
+
+
+def make_ephem_target(target_name, ephemeris, start_time, stop_time, step_size, observatory=None,
+                      ephem_format=None, runid=None, twilight=None, tolerance=None, compact=False):
+    """
+    Select the times target_name is observable from the ephemeris, the CPU bound part of building an ephemeris file.
+
+    :param ephemeris: numpy structured array returned by fetch_ephemeris
+    :param ephem_format: one of ephem_target.EPHEM_FORMATS, or a list of them to write a file in each.
+    :param tolerance: Quantity, when given only the points needed to follow the target to within this angle by
+    linear interpolation are kept, along with the start and end of every night, rather than every step.
+    :param compact: write CFHT API files without whitespace.
+    :return: EphemTarget holding the observable points.
+    """
+    if twilight is None:
+        twilight = visibility.TwilightTable(start_time, stop_time, observatory)
+
+    et = EphemTarget(target_name.replace(" ", "_"), ephem_format=ephem_format, runid=runid, compact=compact)
+
+    # Evaluate the ephemeris over the whole run at once, the Horizons grid may be coarser than step_size.
+    interpolator = EphemerisInterpolator(ephemeris)
+    if interpolator.max_error > MAX_INTERPOLATION_ERROR:
+        logging.warning("Interpolating {} may be in error by up to {:.3f}, use a smaller query step.".format(
+            target_name, interpolator.max_error))
+    else:
+        logging.info("Maximum interpolation error for {} is {:.3f}".format(target_name, interpolator.max_error))
+    times = visibility.time_grid(start_time, stop_time, step_size)
+    ra, dec, mag = interpolator.predict(times)
+
+    mask = visibility.night_mask(times, ra, dec, observatory=observatory, twilight=twilight)
+    if tolerance is None:
+        visible = numpy.flatnonzero(mask)
+    else:
+        visible = adaptive_indices(times.jd, ra, dec, visibility.windows(mask), tolerance=tolerance)
+    ra_rate, dec_rate = interpolator.rates(times[visible])
+    et.extend(times[visible], ra[visible], dec[visible], mag[visible], dra=ra_rate, ddec=dec_rate)
+    return et
+
+
+def write_ephem_file(target_name, ephemeris, start_time, stop_time, step_size, observatory=None,
+                     ephem_format=None, runid=None, twilight=None, tolerance=None, compact=False):
+    """
+    Select the times target_name is observable from the ephemeris and save them, see make_ephem_target.
+
+    :return: number of ephemeris points written.
+    """
+    et = make_ephem_target(target_name, ephemeris, start_time, stop_time, step_size, observatory=observatory,
+                           ephem_format=ephem_format, runid=runid, twilight=twilight, tolerance=tolerance,
+                           compact=compact)
+    et.save()
+    return len(et)
+
 
 def build_ephem_files(target_name, start_time, stop_time, step_size=None, observatory=None,
-                      ephem_format=None, runid=None):
+                      ephem_format=None, runid=None, twilight=None, cache=None, query_step=None, tolerance=None,
+                      compact=False):
     if observatory is None:
         observatory = _cfht
     if step_size is None:
         step_size = 30*units.minute
+    if query_step is None:
+        query_step = step_size
     start_time = Time(start_time)
     stop_time = Time(stop_time)
-    sun = ephem.Sun()
-    fb = ephem.FixedBody()
-
-    et = EphemTarget(target_name.replace(" ", "_"), ephem_format=ephem_format, runid=runid)
-    body = horizons.Body(target_name.replace("_", " "), start_time=start_time, stop_time=stop_time,
-                         step_size=step_size, center='568')
-    current_time = start_time
-    body.predict(current_time)
-    while current_time < stop_time:
-        target_up = False
-        observatory.date = current_time.iso.replace('-', '/')
-        observatory.horizon = math.radians(-7)
-        sun.compute(observatory)
-        sun_rise = Time(str(sun.rise_time).replace('/', '-'))
-        sun_set = Time(str(sun.set_time).replace('/', '-'))
-
-        if current_time < sun_set or current_time > sun_rise:
-            sun_down = False
-        else:
-            sun_down = True
-
-        body.predict(current_time)
-        fb._ra = body.coordinate.ra.radian
-        fb._dec = body.coordinate.dec.radian
-
-        observatory.horizon = math.radians(40)
-        fb.compute(observatory)
-        fb_rise_time = Time(str(fb.rise_time).replace('/', '-'))
-        fb_set_time = Time(str(fb.set_time).replace('/', '-'))
-
-        if fb_rise_time < current_time < fb_set_time:
-            target_up = True
-        if fb_rise_time < current_time and fb_set_time < current_time:
-            target_up = False
-        if fb_rise_time > current_time and fb_set_time > current_time:
-            target_up = True
-        if fb_rise_time > current_time > fb_set_time:
-            target_up = False
-
-        if target_up and sun_down:
-            coordinate = deepcopy(body.coordinate)
-            coordinate.mag = body.mag
-            coordinate.obstime = current_time
-            et.append(coordinate)
-        current_time += step_size
 
-    et.save()
+    ephemeris = fetch_ephemeris(target_name, start_time, stop_time, query_step, cache=cache)
+    return write_ephem_file(target_name, ephemeris, start_time, stop_time, step_size, observatory=observatory,
+                            ephem_format=ephem_format, runid=runid, twilight=twilight, tolerance=tolerance,
+                            compact=compact)
+
+
+def _write_task(target_name, ephemeris, start_time, stop_time, step_size, site, ephem_format, runid, twilight,
+                tolerance, compact):
+    try:
+        return target_name, write_ephem_file(target_name, ephemeris, start_time, stop_time, step_size,
+                                             observatory=site, ephem_format=ephem_format, runid=runid,
+                                             twilight=twilight, tolerance=tolerance, compact=compact), None
+    except Exception as ex:
+        logging.debug("Writing {} failed".format(target_name), exc_info=True)
+        return target_name, None, "{}: {}".format(type(ex).__name__, ex)
+
 
+def _summarize(results, failures):
+    sys.stdout.write("Wrote ephemeris files for {} of {} targets.\n".format(len(results),
+                                                                          len(results) + len(failures)))
+    for target_name in sorted(failures):
+        sys.stdout.write("  {}: FAILED {}\n".format(target_name, failures[target_name]))
 
-def main(target_names, start_time, stop_time, step_size=None, observatory=None, ephem_format=None, runid=None):
+
+def main(target_names, start_time, stop_time, step_size=None, observatory=None, ephem_format=None, runid=None,
+         cache=None, jobs=1, max_requests=DEFAULT_MAX_REQUESTS, query_step=None, tolerance=None, compact=False):
     """
     Given a list of targets build an ephemeris file to load to CFHT
     This routine will only put out lines for when the target is up.
 
+    The Horizons queries run on a pool of max_requests threads, so that no more than that many requests are in
+    flight, and with jobs > 1 each fetched ephemeris is handed to a pool of jobs processes for the visibility
+    filtering and writing.  A target that fails in either stage is reported in the summary at the end and does not
+    stop the others.
+
     :param target_names:
     :param start_time:
     :param stop_time:
     :param step_size:
     :param observatory:
-    :return:
+    :param cache: horizons_cache.HorizonsCache to fetch the Horizons ephemerides through.
+    :param jobs: number of processes doing the visibility filtering and writing.
+    :param max_requests: maximum number of concurrent Horizons requests.
+    :param query_step: spacing of the Horizons grid that is interpolated to step_size, defaults to step_size.
+    :param tolerance: Quantity, write only the points needed to follow each target to this accuracy.
+    :param compact: write CFHT API files without whitespace.
+    :return: dictionary of number of points written per target, and dictionary of errors per failed target.
     """
 
     start_time = Time(start_time)
@@ -92,12 +159,65 @@ def main(target_names, start_time, stop_time, step_size=None, observatory=None,
     if step_size is None:
         step_size = 30 * units.minute
 
+    if query_step is None:
+        query_step = step_size
+
     if observatory is None:
         observatory = _cfht
 
-    for target_name in target_names:
-        build_ephem_files(target_name, start_time, stop_time, step_size=step_size, observatory=observatory,
-                          ephem_format=ephem_format, runid=runid)
+    if cache is None:
+        cache = horizons_cache.HorizonsCache()
+
+    # The Sun is the same for every target, so compute the twilight times of each night just once.
+    twilight = visibility.TwilightTable(start_time, stop_time, observatory)
+
+    results = {}
+    failures = {}
+    # Horizons is queried with the designation, the files are named with the target name.
+    query_names = OrderedDict((target_name.replace("_", " "), target_name) for target_name in target_names)
+    fetches = ((query_names[name], ephemeris, error)
+               for name, ephemeris, error in cache.fetch_many(query_names.keys(), start_time, stop_time,
+                                                              step_size=query_step, center='568',
+                                                              max_requests=max_requests))
+    if jobs <= 1:
+        for target_name, ephemeris, error in fetches:
+            if error is None:
+                target_name, n_points, error = _write_task(target_name, ephemeris, start_time, stop_time, step_size,
+                                                           observatory, ephem_format, runid, twilight, tolerance,
+                                                           compact)
+            if error is None:
+                results[target_name] = n_points
+            else:
+                failures[target_name] = error
+        _summarize(results, failures)
+        return results, failures
+
+    # ephem.Observer does not pickle, the worker processes get the site as a plain tuple.
+    site = visibility.site(observatory)
+    write_pool = Pool(jobs)
+    try:
+        writes = []
+        for target_name, ephemeris, error in fetches:
+            if error is not None:
+                logging.error("Failed to fetch {}: {}".format(target_name, error))
+                failures[target_name] = error
+                continue
+            logging.info("Fetched {}".format(target_name))
+            writes.append(write_pool.apply_async(_write_task, (target_name, ephemeris, start_time, stop_time,
+                                                               step_size, site, ephem_format, runid, twilight,
+                                                               tolerance, compact)))
+        for write in writes:
+            target_name, n_points, error = write.get()
+            if error is not None:
+                logging.error("Failed to write {}: {}".format(target_name, error))
+                failures[target_name] = error
+            else:
+                results[target_name] = n_points
+    finally:
+        write_pool.close()
+        write_pool.join()
+    _summarize(results, failures)
+    return results, failures
 
 
 if __name__ == '__main__':
@@ -106,12 +226,39 @@ if __name__ == '__main__':
     parser.add_argument('end_time', help="Date at end of dark run.")
     parser.add_argument('target_names', nargs="+", help="Names of targets to build ephemeris files for.")
     parser.add_argument('--runid', default='17AC99')
-    parser.add_argument('--ephem-format', default='CFHT API')
-    parser.add_argument('--step-size', help="size of time step for ephemeris.", default=300 * units.minute)
+    parser.add_argument('--ephem-format', nargs='+', choices=EPHEM_FORMATS, default=['CFHT API'],
+                        help="One or more formats to write, each target is written in every format from a single "
+                             "Horizons query.")
+    parser.add_argument('--compact', help="Write CFHT API files without whitespace.", action="store_true",
+                        default=False)
+    parser.add_argument('--step-size', help="size of time step for ephemeris, in minutes.", default=300 * units.minute,
+                        type=float)
+    parser.add_argument('--query-step', help="size of time step of the Horizons query, in minutes. "
+                                             "Defaults to the ephemeris step size.", default=None, type=float)
+    parser.add_argument('--tolerance', help="Only write the points needed to follow the target to this many arcsec "
+                                            "by linear interpolation.", default=None, type=float)
     parser.add_argument('--observatory', default=_cfht)
+    parser.add_argument('--jobs', help="Number of processes building ephemeris files.", default=1, type=int)
+    parser.add_argument('--verbose', help="Verbose message reporting.", action="store_true", default=False)
+    parser.add_argument('--debug', help="Provide debuging information.", action="store_true", default=False)
+    horizons_cache.add_cache_arguments(parser)
 
     args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    logging.basicConfig(level=logging.ERROR)
+
     if not isinstance(args.step_size, units.Quantity): 
        args.step_size *= units.minute
-    main(args.target_names, args.start_time, args.end_time, args.step_size, args.observatory, args.ephem_format,
-         args.runid)
+    if args.query_step is not None:
+        args.query_step *= units.minute
+    if args.tolerance is not None:
+        args.tolerance *= units.arcsec
+    results, failures = main(args.target_names, args.start_time, args.end_time, args.step_size, args.observatory,
+                             args.ephem_format, args.runid, horizons_cache.cache_from_args(args), jobs=args.jobs,
+                             max_requests=args.max_requests, query_step=args.query_step, tolerance=args.tolerance,
+                             compact=args.compact)
+    sys.exit(len(failures) > 0 and 1 or 0)
@@ -0,0 +1,267 @@
+"""
+Ephemerides of minor planets propagated locally from their MPCORB orbital elements, in place of querying Horizons.
+
+The osculating elements are propagated as two body orbits about the Sun, solving Kepler's equation for every target
+and time at once, and seen from the observatory through a low precision orbit of the Earth, with light time and
+topocentric corrections.  Planetary perturbations away from the epoch of the elements, and the 0.01 degree accuracy
+of the Earth's orbit, limit the positions to a few arcsec for a distant object near the epoch, good enough to pre-screen
+the visibility of thousands of targets with no network round trips.  Use Horizons for the ephemerides written to ET
+files.
+"""
+import logging
+import math
+import numpy
+from astropy import units
+from astropy.time import Time
+import horizons_cache
+import mpcread
+
+DEFAULT_MPCORB = 'MPCORB.DAT'
+# Propagating is cheap, so many targets are given to one query.
+DEFAULT_BATCH_SIZE = 1000
+
+J2000 = 2451545.0
+# Gaussian gravitational constant, radians/day.
+GAUSS_K = 0.01720209895
+# Mean obliquity of the ecliptic at J2000.
+OBLIQUITY = math.radians(23.4392911)
+SPEED_OF_LIGHT = 173.1446326846693 * units.au / units.day
+EARTH_RADIUS = 6378.137 * units.km
+# East longitude (degrees), rho cos(phi') and rho sin(phi') of the sites known, from the MPC list of observatory codes.
+OBSERVATORY_CODES = {'500': (0.0, 0.0, 0.0),
+                     '568': (204.5278, 0.94171, 0.33725)}
+# Half the interval over which the rates of motion are measured, days.
+RATE_STEP = 5.0 / 1440.0
+
+
+def solve_kepler(mean_anomaly, eccentricity, tolerance=1e-12, max_iterations=50):
+    """
+    Solve Kepler's equation, M = E - e sin(E), by Newton's method for arrays of elliptical orbits.
+
+    :param mean_anomaly: array of mean anomalies, radians.
+    :param eccentricity: array of eccentricities, less than 1, broadcastable with mean_anomaly.
+    :return: array of eccentric anomalies, radians.
+    """
+    mean_anomaly = numpy.remainder(mean_anomaly, 2 * math.pi)
+    eccentricity = eccentricity * numpy.ones_like(mean_anomaly)
+    # starting from pi converges for every eccentricity, M + e sin(M) is quicker for nearly circular orbits.
+    anomaly = numpy.where(eccentricity < 0.8, mean_anomaly + eccentricity * numpy.sin(mean_anomaly), math.pi)
+    for iteration in range(max_iterations):
+        step = ((anomaly - eccentricity * numpy.sin(anomaly) - mean_anomaly) /
+                (1 - eccentricity * numpy.cos(anomaly)))
+        anomaly -= step
+        if numpy.all(numpy.abs(step) < tolerance):
+            break
+    return anomaly
+
+
+def _ecliptic_to_equatorial(x, y, z):
+    return (x,
+            y * math.cos(OBLIQUITY) - z * math.sin(OBLIQUITY),
+            y * math.sin(OBLIQUITY) + z * math.cos(OBLIQUITY))
+
+
+def heliocentric_positions(elements, jd):
+    """
+    Two body heliocentric positions of orbits at a set of times.
+
+    :param elements: numpy structured array with mpcread.ELEMENTS_DTYPE
+    :param jd: array of Julian dates (TT).
+    :return: x, y, z arrays of shape (len(elements), len(jd)) in au, equatorial J2000.
+    """
+    jd = numpy.atleast_2d(jd)
+    column = lambda name: numpy.asarray(elements[name], dtype='f8').reshape(-1, 1)
+    a = column('a')
+    e = column('e')
+    n = numpy.where(column('n') > 0, numpy.radians(column('n')), GAUSS_K / a ** 1.5)
+    anomaly = solve_kepler(numpy.radians(column('M')) + n * (jd - column('epoch')), e)
+    x_orbit = a * (numpy.cos(anomaly) - e)
+    y_orbit = a * numpy.sqrt(1 - e ** 2) * numpy.sin(anomaly)
+    peri, node, incl = [numpy.radians(column(name)) for name in ('peri', 'node', 'incl')]
+    cos_peri, sin_peri = numpy.cos(peri), numpy.sin(peri)
+    cos_node, sin_node = numpy.cos(node), numpy.sin(node)
+    cos_incl, sin_incl = numpy.cos(incl), numpy.sin(incl)
+    x = (x_orbit * (cos_peri * cos_node - sin_peri * sin_node * cos_incl) -
+         y_orbit * (sin_peri * cos_node + cos_peri * sin_node * cos_incl))
+    y = (x_orbit * (cos_peri * sin_node + sin_peri * cos_node * cos_incl) -
+         y_orbit * (sin_peri * sin_node - cos_peri * cos_node * cos_incl))
+    z = (x_orbit * sin_peri + y_orbit * cos_peri) * sin_incl
+    return _ecliptic_to_equatorial(x, y, z)
+
+
+def earth_positions(jd):
+    """
+    Heliocentric position of the Earth from the low precision solar coordinates of the Astronomical Almanac.
+
+    :param jd: array of Julian dates (TT).
+    :return: x, y, z arrays in au, equatorial J2000.
+    """
+    days = numpy.asarray(jd, dtype='f8') - J2000
+    mean_longitude = numpy.radians(280.460 + 0.9856474 * days)
+    mean_anomaly = numpy.radians(357.528 + 0.9856003 * days)
+    # longitude of the Sun less the precession since J2000, so the positions are in the J2000 frame.
+    longitude = (mean_longitude + numpy.radians(1.915) * numpy.sin(mean_anomaly) +
+                 numpy.radians(0.020) * numpy.sin(2 * mean_anomaly) -
+                 numpy.radians(1.39689) * days / 36525.0)
+    distance = 1.00014 - 0.01671 * numpy.cos(mean_anomaly) - 0.00014 * numpy.cos(2 * mean_anomaly)
+    return _ecliptic_to_equatorial(-distance * numpy.cos(longitude), -distance * numpy.sin(longitude),
+                                   numpy.zeros_like(days))
+
+
+def site_positions(jd, center='568'):
+    """
+    Geocentric position of an observatory, rotating with the Earth.
+
+    :param jd: array of Julian dates (UT).
+    :param center: MPC observatory code, one of OBSERVATORY_CODES.
+    :return: x, y, z arrays in au, equatorial.
+    """
+    try:
+        longitude, rho_cos_phi, rho_sin_phi = OBSERVATORY_CODES[str(center)]
+    except KeyError:
+        raise ValueError("No location for observatory code {}, known codes are {}.".format(
+            center, ", ".join(sorted(OBSERVATORY_CODES))))
+    radius = EARTH_RADIUS.to(units.au).value
+    sidereal_time = numpy.radians(280.46061837 + 360.98564736629 * (numpy.asarray(jd, dtype='f8') - J2000) +
+                                  longitude)
+    return (radius * rho_cos_phi * numpy.cos(sidereal_time),
+            radius * rho_cos_phi * numpy.sin(sidereal_time),
+            radius * rho_sin_phi * numpy.ones_like(sidereal_time))
+
+
+def apparent_magnitude(H, G, r, delta, observer_distance):
+    """
+    Magnitude in the IAU H, G system.
+
+    :param r: heliocentric distance of the target, au.
+    :param delta: distance from the observer to the target, au.
+    :param observer_distance: heliocentric distance of the observer, au.
+    """
+    cos_phase = numpy.clip((r ** 2 + delta ** 2 - observer_distance ** 2) / (2 * r * delta), -1, 1)
+    tan_half_phase = numpy.tan(numpy.arccos(cos_phase) / 2)
+    phi1 = numpy.exp(-3.33 * tan_half_phase ** 0.63)
+    phi2 = numpy.exp(-1.87 * tan_half_phase ** 1.22)
+    return H + 5 * numpy.log10(r * delta) - 2.5 * numpy.log10((1 - G) * phi1 + G * phi2)
+
+
+def propagate(elements, times, center='568'):
+    """
+    Astrometric positions of orbits seen from an observatory.
+
+    :param elements: numpy structured array with mpcread.ELEMENTS_DTYPE
+    :param times: Time array (UTC).
+    :param center: MPC observatory code, one of OBSERVATORY_CODES.
+    :return: ra, dec (degrees) and mag arrays of shape (len(elements), len(times)).
+    """
+    jd = times.utc.jd
+    jd_tt = times.tt.jd
+    earth = earth_positions(jd_tt)
+    site = site_positions(jd, center)
+    observer = [earth[axis] + site[axis] for axis in range(3)]
+    speed_of_light = SPEED_OF_LIGHT.to(units.au / units.day).value
+
+    # light leaves the target one light time before it is seen, one iteration is enough for the slow moving targets.
+    target = heliocentric_positions(elements, jd_tt)
+    delta = numpy.sqrt(sum((target[axis] - observer[axis]) ** 2 for axis in range(3)))
+    target = heliocentric_positions(elements, jd_tt - delta / speed_of_light)
+    offset = [target[axis] - observer[axis] for axis in range(3)]
+    delta = numpy.sqrt(sum(offset[axis] ** 2 for axis in range(3)))
+
+    ra = numpy.degrees(numpy.arctan2(offset[1], offset[0])) % 360.0
+    dec = numpy.degrees(numpy.arcsin(offset[2] / delta))
+    r = numpy.sqrt(sum(target[axis] ** 2 for axis in range(3)))
+    observer_distance = numpy.sqrt(sum(observer[axis] ** 2 for axis in range(3)))
+    mag = apparent_magnitude(numpy.asarray(elements['H'], dtype='f8').reshape(-1, 1),
+                             numpy.asarray(elements['G'], dtype='f8').reshape(-1, 1), r, delta, observer_distance)
+    return ra, dec, mag
+
+
+def ephemerides(elements, start_time, stop_time, step_size, center='568'):
+    """
+    Ephemerides of orbits on the grid of times a Horizons query for start_time, stop_time and step_size returns.
+
+    :param elements: numpy structured array with mpcread.ELEMENTS_DTYPE
+    :return: numpy structured array with horizons_cache.EPHEMERIS_DTYPE of shape (len(elements), number of times).
+    """
+    start_time = Time(start_time)
+    stop_time = Time(stop_time)
+    # Horizons includes the stop time in the grid.
+    n_steps = int(math.floor(((stop_time - start_time) / step_size).decompose().value + 1e-9)) + 1
+    times = start_time + numpy.arange(max(n_steps, 1)) * step_size
+    step = RATE_STEP * units.day
+    ra, dec, mag = propagate(elements, times, center)
+    ra_before, dec_before, mag_before = propagate(elements, times - step, center)
+    ra_after, dec_after, mag_after = propagate(elements, times + step, center)
+
+    result = numpy.zeros((len(elements), len(times)), dtype=horizons_cache.EPHEMERIS_DTYPE)
+    result['jd'] = times.utc.jd
+    result['ra'] = ra
+    result['dec'] = dec
+    result['mag'] = mag
+    # rates in arcsec/hour, the RA rate including the cos(Dec) term, as Horizons reports them.
+    scale = 3600.0 / (2 * step.to(units.hour).value)
+    result['ra_rate'] = (((ra_after - ra_before + 180.0) % 360.0 - 180.0) * numpy.cos(numpy.radians(dec)) * scale)
+    result['dec_rate'] = (dec_after - dec_before) * scale
+    return result
+
+
+class MPCORBSource(object):
+    """
+    Answer ephemeris queries for the orbits in an MPCORB.DAT file, used as the batch_query of a
+    horizons_cache.HorizonsCache.
+    """
+
+    def __init__(self, filename=DEFAULT_MPCORB):
+        """
+        :param filename: MPCORB.DAT, or an extract of it in the same format, read on the first query.
+        """
+        self.filename = filename
+        self._elements = None
+        self._index = None
+
+    @property
+    def elements(self):
+        if self._elements is None:
+            logging.info("Reading orbital elements from {}".format(self.filename))
+            self._elements = mpcread.read_elements(self.filename)
+            logging.info("Read {} orbits.".format(len(self._elements)))
+        return self._elements
+
+    @property
+    def index(self):
+        """
+        Row of each orbit by unpacked designation, and by number and name for numbered objects, eg. '(136199) Eris'
+        is found as 136199 or Eris.
+        """
+        if self._index is None:
+            index = {}
+            for row, (designation, name) in enumerate(zip(self.elements['designation'], self.elements['name'])):
+                keys = [designation, name]
+                if name.startswith('('):
+                    keys.extend(name[1:].split(')', 1))
+                for key in keys:
+                    index.setdefault(key.strip(), row)
+            index.pop('', None)
+            self._index = index
+        return self._index
+
+    def query(self, names, start_time, stop_time, step_size, center='568'):
+        """
+        Propagate the orbits of names, see horizons_cache.HorizonsCache.query.
+
+        :return: dictionary of numpy structured arrays with horizons_cache.EPHEMERIS_DTYPE, by name.  Names without an
+        orbit in the file are left out.
+        """
+        rows = []
+        found = []
+        for name in names:
+            row = self.index.get(name.replace("_", " "))
+            if row is None:
+                logging.warning("No orbit for {} in {}".format(name, self.filename))
+                continue
+            rows.append(row)
+            found.append(name)
+        if len(rows) == 0:
+            return {}
+        result = ephemerides(self.elements[rows], start_time, stop_time, step_size, center)
+        return dict(zip(found, result))
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 import sys,re
+import logging
 import math, numpy
+import mmap
+import os
 from astropy.io import ascii
 from astropy.time import Time
 
@@ -19,12 +22,122 @@ Kilo='ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
 YY={'I': 1800, 'J': 1900, 'K': 2000}
 
 
+def _char_table(values):
+    """
+    Lookup table from the byte value of a character to its value in the packed formats, -1 for other characters.
+    """
+    table = numpy.full(256, -1, dtype='i8')
+    for char, value in values:
+        table[ord(char)] = value
+    return table
+
+NCODE_VALUE = _char_table((char, idx) for idx, char in enumerate(Ncode))
+KILO_VALUE = _char_table((char, idx) for idx, char in enumerate(Kilo))
+YY_VALUE = _char_table(YY.items())
+DIGIT_VALUE = _char_table((char, int(char)) for char in '0123456789')
+POWERS_OF_TEN = 10 ** numpy.arange(19, dtype='i8')
+
+# Width of an MPCORB.DAT line, shorter lines are padded with blanks.
+LINE_LENGTH = 202
+# Size of the pieces MPCORB.DAT is parsed in, about 80,000 orbits.
+CHUNK_BYTES = 16 * 1024 ** 2
+
+
 def date_unpack(pdate):
     yyyy=YY[pdate[0]]+int(pdate[1:3])
     mm=Ncode.rindex(pdate[3])
     dd=float(Ncode.rindex(pdate[4]))
     return (yyyy, mm, dd)
 
+def _chars(packed, width):
+    """
+    The characters of an array of strings as a (len(packed), width) array of byte values, padded with blanks.
+    """
+    chars = numpy.asarray(packed, dtype='S{}'.format(width)).view('u1').reshape(-1, width).copy()
+    chars[chars == 0] = ord(' ')
+    return chars
+
+
+def _strings(chars):
+    """
+    The rows of an array of byte values as an array of strings, the inverse of _chars.
+    """
+    return numpy.ascontiguousarray(chars, dtype='u1').view('S{}'.format(chars.shape[1])).ravel()
+
+
+def date_unpack_array(pdates):
+    """
+    Unpack an array of packed dates, see date_unpack.
+
+    :return: arrays of year, month and day, the day is NaN where the date is not a packed date.
+    """
+    chars = _chars(pdates, 5)
+    century = YY_VALUE[chars[:, 0]]
+    tens, units = DIGIT_VALUE[chars[:, 1]], DIGIT_VALUE[chars[:, 2]]
+    mm = NCODE_VALUE[chars[:, 3]]
+    dd = NCODE_VALUE[chars[:, 4]].astype('f8')
+    valid = (century >= 0) & (tens >= 0) & (units >= 0) & (mm >= 1) & (dd >= 1)
+    dd[~valid] = numpy.nan
+    return century + 10 * tens + units, mm, dd
+
+
+def desig_unpack_array(desigs):
+    """
+    Unpack an array of packed designations, see desig_unpack.
+
+    :return: array of unpacked designations, those that are not packed numbers or provisional designations are
+    returned as they are.
+    """
+    desigs = numpy.char.strip(numpy.asarray(desigs, dtype='S7'))
+    chars = _chars(desigs, 7)
+    digits = DIGIT_VALUE[chars]
+    blank = chars == ord(' ')
+    result = desigs.astype('S16')
+
+    numbered = digits[:, 0] >= 0
+    if numbered.any():
+        result[numbered] = desigs[numbered].astype('i8').astype('S16')
+
+    kilo = (~numbered & (KILO_VALUE[chars[:, 0]] >= 0) & (digits[:, 1] >= 0) &
+            numpy.all((digits[:, 1:] >= 0) | blank[:, 1:], axis=1))
+    if kilo.any():
+        number = 100000 + KILO_VALUE[chars[kilo, 0]] * 10000 + _strings(chars[kilo, 1:]).astype('i8')
+        result[kilo] = number.astype('S16')
+
+    provisional = (~numbered & ~kilo & (YY_VALUE[chars[:, 0]] >= 0) & (digits[:, 1] >= 0) & (digits[:, 2] >= 0) &
+                   (NCODE_VALUE[chars[:, 4]] >= 0) & (digits[:, 5] >= 0))
+    if provisional.any():
+        # build the unpacked designations character by character, the trailing NULs are dropped by the S dtype.
+        chars = chars[provisional]
+        century = YY_VALUE[chars[:, 0]] // 100
+        cycle = NCODE_VALUE[chars[:, 4]] * 10 + DIGIT_VALUE[chars[:, 5]]
+        unpacked = numpy.zeros((len(chars), 10), dtype='u1')
+        unpacked[:, 0] = ord('0') + century // 10
+        unpacked[:, 1] = ord('0') + century % 10
+        unpacked[:, 2:4] = chars[:, 1:3]
+        unpacked[:, 4] = ord(' ')
+        unpacked[:, 5] = chars[:, 3]
+        unpacked[:, 6] = chars[:, 6]
+        n_digits = (cycle > 0).astype('i8') + (cycle > 9) + (cycle > 99)
+        for place in range(3):
+            power = numpy.maximum(n_digits - 1 - place, 0)
+            unpacked[:, 7 + place] = numpy.where(n_digits > place, ord('0') + cycle // 10 ** power % 10, 0)
+        result[provisional] = _strings(unpacked)
+    return result
+
+
+def calendar_jd(year, month, day):
+    """
+    Julian date at the start of a (proleptic Gregorian) calendar day, works element-wise on arrays.
+
+    :param day: day of the month, may have a fractional part.
+    """
+    a = (14 - month) // 12
+    y = year + 4800 - a
+    m = month + 12 * a - 3
+    return day + (153 * m + 2) // 5 + 365 * y + y // 4 - y // 100 + y // 400 - 32045.5
+
+
 def desig_pack(desig):
     try:
         f = int(desig)
@@ -66,58 +179,178 @@ def desig_unpack(desig):
     return yyyy+' '+Mcode+cycle
     
 
+# Orbital elements of the MPCORB format, angles in degrees, epoch as a Julian date (TT) and n in degrees/day.  U is
+# the uncertainty parameter, -1 if not given, nobs the number of observations, -1 if not given, last_obs the
+# Julian date of the last observation, NaN if not given, and arc the length of the observed arc in years, NaN if it
+# can not be read.  packed is the designation as given in the file.
+ELEMENTS_DTYPE = numpy.dtype([('designation', 'S16'),
+                              ('packed', 'S7'),
+                              ('name', 'S32'),
+                              ('epoch', 'f8'),
+                              ('M', 'f8'),
+                              ('peri', 'f8'),
+                              ('node', 'f8'),
+                              ('incl', 'f8'),
+                              ('e', 'f8'),
+                              ('n', 'f8'),
+                              ('a', 'f8'),
+                              ('H', 'f8'),
+                              ('G', 'f8'),
+                              ('U', 'i4'),
+                              ('nobs', 'i4'),
+                              ('last_obs', 'f8'),
+                              ('arc', 'f8')])
+
+
+def _float_column(chars, start, stop, default=numpy.nan):
+    """
+    Parse a fixed width column of decimal numbers, blanks get default and anything else that is not a number NaN.
+
+    The digits are gathered into an integer and divided by a power of ten, which rounds exactly as float() does.
+    """
+    # one contiguous row per character position, so each step of the loop below reads contiguous memory.
+    field = chars[:, start:stop].T.copy()
+    is_digit = (field >= ord('0')) & (field <= ord('9'))
+    point = field == ord('.')
+    sign = (field == ord('-')) | (field == ord('+'))
+    blank = field == ord(' ')
+    valid = numpy.all(is_digit | point | sign | blank, axis=0) & numpy.any(is_digit, axis=0)
+    mantissa = numpy.zeros(field.shape[1], dtype='i8')
+    decimals = numpy.zeros(field.shape[1], dtype='i8')
+    after_point = numpy.zeros(field.shape[1], dtype=bool)
+    after_sign = numpy.zeros(field.shape[1], dtype=bool)
+    after_digit = numpy.zeros(field.shape[1], dtype=bool)
+    for position in range(len(field)):
+        digit = is_digit[position]
+        mantissa *= 1 + 9 * digit
+        mantissa += digit * (field[position] - ord('0'))
+        decimals += digit & after_point
+        # a second decimal point or sign, or a sign after the digits, makes it not a number.
+        valid &= ~(point[position] & after_point) & ~(sign[position] & (after_sign | after_digit))
+        after_point |= point[position]
+        after_sign |= sign[position]
+        after_digit |= digit
+    values = mantissa / POWERS_OF_TEN[decimals].astype('f8')
+    values[numpy.any(field == ord('-'), axis=0)] *= -1
+    values[~valid] = numpy.nan
+    values[numpy.all(blank, axis=0)] = default
+    return values
+
+
+def parse_elements(lines):
+    """
+    Parse MPCORB.DAT format lines of orbits, all at once.
+
+    Orbits without an absolute magnitude get H=20 and G=0, as in main.  Lines whose orbital elements can not be read
+    are left out.
+
+    :param lines: list of the lines, as str.
+    :return: numpy structured array with ELEMENTS_DTYPE
+    """
+    chars = _chars(lines, LINE_LENGTH)
+    elements = numpy.zeros(len(chars), dtype=ELEMENTS_DTYPE)
+    elements['packed'] = numpy.char.strip(_strings(chars[:, 0:7]))
+    elements['designation'] = desig_unpack_array(elements['packed'])
+    elements['name'] = numpy.char.strip(_strings(chars[:, 166:194]))
+    elements['epoch'] = calendar_jd(*date_unpack_array(_strings(chars[:, 20:25])))
+    for name, start, stop in (('M', 26, 35), ('peri', 37, 46), ('node', 48, 57), ('incl', 59, 68), ('e', 70, 79),
+                              ('n', 80, 91), ('a', 92, 103)):
+        elements[name] = _float_column(chars, start, stop)
+    elements['H'] = _float_column(chars, 8, 13, default=20.0)
+    elements['G'] = _float_column(chars, 14, 19, default=0.0)
+    elements['U'] = numpy.where(DIGIT_VALUE[chars[:, 105]] >= 0, DIGIT_VALUE[chars[:, 105]], -1)
+    nobs = _float_column(chars, 117, 122)
+    elements['nobs'] = numpy.where(numpy.isfinite(nobs), nobs, -1)
+    elements['last_obs'] = calendar_jd(_float_column(chars, 194, 198), _float_column(chars, 198, 200),
+                                       _float_column(chars, 200, 202))
+    # the arc is given as the years of the first and last observations, 'YYYY-YYYY', or for a single opposition as
+    # 'NNNN days'.
+    first, last = _float_column(chars, 127, 131), _float_column(chars, 132, 136)
+    days = _strings(chars[:, 132:136]) == 'days'
+    elements['arc'] = numpy.where(chars[:, 131] == ord('-'), last - first, numpy.where(days, first / 365.25, numpy.nan))
+
+    valid = numpy.ones(len(elements), dtype=bool)
+    for name in ('epoch', 'M', 'peri', 'node', 'incl', 'e', 'n', 'a', 'H', 'G'):
+        valid &= numpy.isfinite(elements[name])
+    if not valid.all():
+        logging.debug("Skipping {} lines that are not orbits.".format(numpy.sum(~valid)))
+    return elements[valid]
+
+
+def iter_elements(filename, chunk_bytes=CHUNK_BYTES):
+    """
+    Read the orbital elements from an MPCORB.DAT format file a piece at a time.
+
+    The file is memory mapped and parsed chunk_bytes at a time, so memory use is bounded whatever the size of the
+    file.  Lines that are not orbits, such as the header, are skipped.
+
+    :param filename: MPCORB.DAT or an extract of it in the same format.
+    :return: iterator of numpy structured arrays with ELEMENTS_DTYPE
+    """
+    with open(filename, 'rb') as f_handle:
+        if os.fstat(f_handle.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while start < len(data):
+                stop = data.find('\n', min(start + chunk_bytes, len(data)))
+                stop = stop < 0 and len(data) or stop + 1
+                lines = [line for line in data[start:stop].split('\n')
+                         if len(line) >= 103 and line[0] != '#' and line[0:3] != '---']
+                start = stop
+                if len(lines) > 0:
+                    yield parse_elements(lines)
+        finally:
+            data.close()
+
+
+def read_elements(filename, chunk_bytes=CHUNK_BYTES):
+    """
+    Read all the orbital elements from an MPCORB.DAT format file, see iter_elements.
+
+    :return: numpy structured array with ELEMENTS_DTYPE
+    """
+    chunks = list(iter_elements(filename, chunk_bytes=chunk_bytes))
+    if len(chunks) == 0:
+        return numpy.zeros(0, dtype=ELEMENTS_DTYPE)
+    return numpy.concatenate(chunks)
+
+
 def main():
-    f=open('/Users/kavelaarsj/MPCORB.DAT')
-    #f=open('schwamb_orbits.dat')
-    lines=f.readlines()
-    f.close()
+    filename='/Users/kavelaarsj/MPCORB.DAT'
+    #filename='schwamb_orbits.dat'
     
     import ephem,sys
     kbo=ephem.EllipticalBody()
-    line=lines.pop(0)
-    while (line[0:3]!="---") : 
-       line=lines.pop(0)
-    
-    lines.append(line)
     nobj=0
     lineCount=0
-    for line in lines:
+    for row in (row for elements in iter_elements(filename) for row in elements):
         lineCount=lineCount+1
         if lineCount %1000 == 0 : 
     	    sys.stderr.write("# Line: %d \n" % ( lineCount)) 
-        if line[0]=='#' or len(line) < 103 or line[0:3]=='---':
-            #sys.stderr.write(line)
-            continue
         
-        if len(line[8:13].strip()):
-            kbo._H=float(line[8:13])
-            kbo._G=float(line[14:19])
-        else:
-            kbo._H=20
-            kbo._G=0
-        arc = line[127:136]
-        try:
-            if 'days' in arc:
-    	        arc = int(arc.split()[0])/365.25
-            else:  
-                dt = -eval(arc)
-        except:
-            sys.stderr.write("Error parsing the arc length value: {}".format(arc))
+        if not numpy.isfinite(row['arc']):
+            sys.stderr.write("Error parsing the arc length value of {}".format(row['packed']))
             continue
-        kbo._epoch_M=date_unpack(line[20:25].strip())
-        kbo._M=float(line[26:35].strip())
-        kbo._om=float(line[37:46].strip())
-        kbo._Om=float(line[48:57].strip())
-        kbo._inc=float(line[59:68].strip())
-        kbo._e=float(line[70:79].strip())
+        # arc length in years, for use in cond and the columns.
+        arc = dt = row['arc']
+        kbo._H=row['H']
+        kbo._G=row['G']
+        kbo._epoch_M=ephem.date(row['epoch'] - 2415020.0)
+        kbo._M=row['M']
+        kbo._om=row['peri']
+        kbo._Om=row['node']
+        kbo._inc=row['incl']
+        kbo._e=row['e']
         kbo._epoch='2017/09/04'
-        kbo._a=float(line[92:103].strip())
-        try:
-           U = int(line[105])
-           nobs = int(line[117:122])
-           last_obs = Time("{}-{}-{}".format(line[194:198],line[198:200],line[200:202]))
-        except:
-           print line
+        kbo._a=row['a']
+        if row['U'] >= 0 and row['nobs'] >= 0 and numpy.isfinite(row['last_obs']):
+           U = row['U']
+           nobs = row['nobs']
+           last_obs = Time(row['last_obs'], format='jd')
+        else:
+           print row['designation']
            U = 9
            nobs = 3
            last_obs = Time("2017-01-01")
@@ -129,16 +362,12 @@ def main():
         H= kbo._H
         i= kbo._inc
         kbo.compute(ephem.date('2011/12/22'))
-        kbo.name=desig_unpack(line[0:7].strip()) 
+        kbo.name=row['designation']
         T_J = (5.2/a) + 2.0 * math.sqrt((1-e**2)*(a/5.2)) * math.cos(i)
         if eval(cond): 
-           if line[0]=='P' or line[0]=='T':
+           if row['packed'].startswith(('P', 'T')):
               # Ignore the PLS and T (?) astroid surveys.
               continue
-           #try : 
-           kbo.name=desig_unpack(line[0:7].strip()) 
-           #except : 
-           #   sys.stderr.write(line[0:7].strip())
            #nobj = nobj+1
            print "%20s %5.1f %5.1f %5.1f %f %f %f" % ( kbo.name.replace(" ","_"), a, e, math.degrees(i), H, math.degrees(kbo.ra), math.degrees(kbo.dec) )
            for column in columns:
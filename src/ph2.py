@@ -3,15 +3,120 @@ import json
 import argparse
 import numpy
 import sys
-import copy
+import collections
+import gzip
+import os
+import re
+import string
 from astropy.coordinates import SkyCoord
 from astropy import units
 import logging
+import visibility
+from ephem_target import ROWS_PER_WRITE
 
 # These are the exposure times set in PH2 on CFHT (or must be) so that we get the correct ones.
 # First exposure time is I1, then I2 etc.
 # Besure these exposure times match whats in the phase 2.
 IC_exptimes = [40, 80, 120, 160, 200, 240, 300, 340, 380, 420, 440, 480, 500]
+# Exposure times are scaled off the exposure, in seconds, needed for a source of the zero point magnitude and are kept
+# between the shortest and longest exposure times before picking an IC.
+EXPTIME_ZERO_POINT_MAG = 24.5
+EXPTIME_ZERO_POINT = 300.0
+MIN_EXPTIME = 40
+MAX_EXPTIME = 499
+IC_EXPTIMES = numpy.array(IC_exptimes)
+
+# Time added to each OB's exposure for acquisition and readout, in seconds.
+OB_OVERHEAD = 40
+# OBs in an OG are all within this radius of the first OB and take no longer than the time budget, in seconds.
+OG_RADIUS = 10 * units.degree
+OG_TIME_BUDGET = 3000.0
+
+PackedGroup = collections.namedtuple('PackedGroup', ['ob_tokens', 'duration'])
+# nights are the nights, see visibility.local_night, the OG is planned for, one for the OG and one for each repeat.
+ScheduledGroup = collections.namedtuple('ScheduledGroup', ['ob_tokens', 'duration', 'nights'])
+
+SECONDS_PER_DAY = 86400.0
+# Spacing, in days, taken for the ephemeris points of a target with no more than one point in any night, the default
+# minor_planet_ephemeris --step-size.
+DEFAULT_EPHEMERIS_STEP = 300.0 / 1440.0
+
+# Bytes read at a time when scanning and copying CFHT API target files.
+READ_SIZE = 2 ** 16
+EPHEMERIS_POINTS_PATTERN = re.compile(r'"ephemeris_points"\s*:\s*\[')
+EPHEMERIS_POINTS_PLACEHOLDER = "@ephemeris_points@"
+# ephem_target.EphemTarget writes the MJD of each point as its epoch_millis.
+EPOCH_PATTERN = re.compile(r'"epoch_millis"\s*:\s*"?([-+.0-9eE]+)')
+
+# Layout of the PH2 program JSON.
+JSON_INDENT = " " * 4
+JSON_SEPARATORS = (', ', ': ')
+
+def load_exposure_config(filename):
+    """
+    Set the exposure time table from a JSON file, so the ICs and scaling can be retuned without changing the code.
+
+    The file holds a dictionary with any of the keys IC_exptimes (list of the exposure times of I1, I2, ...),
+    zero_point_mag, zero_point_exptime, min_exptime and max_exptime, those not given keep their current values, except
+    that max_exptime defaults to just under the longest IC when IC_exptimes is given, so the longest IC can be picked.
+
+    :param filename: name of the JSON file.
+    """
+    global IC_exptimes, IC_EXPTIMES, EXPTIME_ZERO_POINT_MAG, EXPTIME_ZERO_POINT, MIN_EXPTIME, MAX_EXPTIME
+    with open(filename) as f_handle:
+        config = json.load(f_handle)
+    unknown = set(config) - set(['IC_exptimes', 'zero_point_mag', 'zero_point_exptime', 'min_exptime',
+                                  'max_exptime'])
+    if unknown:
+        raise ValueError("Unknown exposure configuration keys in {}: {}".format(filename, sorted(unknown)))
+    exptimes = numpy.array(config.get('IC_exptimes', IC_exptimes))
+    if exptimes.ndim != 1 or len(exptimes) == 0 or numpy.any(numpy.diff(exptimes) <= 0):
+        raise ValueError("IC_exptimes in {} must be a list of increasing exposure times.".format(filename))
+    max_exptime = MAX_EXPTIME
+    if 'IC_exptimes' in config:
+        max_exptime = numpy.nextafter(float(exptimes[-1]), -numpy.inf)
+    min_exptime = float(config.get('min_exptime', MIN_EXPTIME))
+    max_exptime = float(config.get('max_exptime', max_exptime))
+    if min_exptime > max_exptime:
+        raise ValueError("min_exptime {} is longer than max_exptime {} in {}.".format(min_exptime, max_exptime,
+                                                                                    filename))
+    longest = numpy.searchsorted(exptimes, max_exptime, side='right')
+    if longest < len(exptimes) - 1:
+        logging.warning("max_exptime {} in {} is shorter than the ICs {} and they will never be used.".format(
+            max_exptime, filename, exptimes[longest + 1:].tolist()))
+    IC_exptimes = exptimes.tolist()
+    IC_EXPTIMES = exptimes
+    EXPTIME_ZERO_POINT_MAG = float(config.get('zero_point_mag', EXPTIME_ZERO_POINT_MAG))
+    EXPTIME_ZERO_POINT = float(config.get('zero_point_exptime', EXPTIME_ZERO_POINT))
+    MIN_EXPTIME = min_exptime
+    MAX_EXPTIME = max_exptime
+
+
+def exposure_time_indices(mags):
+    """
+    Index into IC_exptimes of the exposure time of each magnitude: the shortest IC longer than the exposure needed,
+    scaling off a 300s exposure needed for a 24.5 mag source.
+
+    Mimimum exposure time is 40s (CFHT Overhead)
+    :param mags: array of magnitudes.
+    :return: numpy array of int
+    """
+    mags = numpy.asarray(mags, dtype='f8')
+    exact_exptime = EXPTIME_ZERO_POINT / ((10 ** ((EXPTIME_ZERO_POINT_MAG - mags) / 2.5)) ** 2)
+    exact_exptime = numpy.clip(exact_exptime, MIN_EXPTIME, MAX_EXPTIME)
+    return numpy.minimum(numpy.searchsorted(IC_EXPTIMES, exact_exptime, side='right'), len(IC_EXPTIMES) - 1)
+
+
+def instrument_configurations(mags):
+    """
+    The exposure configuration of each magnitude, see exposure_time_indices.
+
+    :param mags: array of magnitudes.
+    :return: numpy arrays of the IC_exptimes indices and exposure times, and the list of IC identifiers ("I<n>").
+    """
+    indices = exposure_time_indices(mags)
+    return indices, IC_EXPTIMES[indices], ["I{}".format(idx + 1) for idx in indices.tolist()]
+
 
 def exposure_time_index(mag):
     """
@@ -20,9 +125,7 @@ def exposure_time_index(mag):
     Mimimum exposure time is 40s (CFHT Overhead)
     :return: float
     """
-    cuts = numpy.array(IC_exptimes)
-    exact_exptime = min(499, max(40, 300.0 / ((10 ** ((24.5 - mag) / 2.5)) ** 2)))
-    return len(cuts) - (exact_exptime < cuts).sum()
+    return int(exposure_time_indices([mag])[0])
 
 
 def exposure_time(mag):
@@ -33,6 +136,150 @@ def instrument_configuration_identifier(mag):
     return "I{}".format(exposure_time_index(mag)+1)
 
 
+def _unit_vectors(coordinates):
+    ra = coordinates.ra.radian
+    dec = coordinates.dec.radian
+    return numpy.column_stack((numpy.cos(dec) * numpy.cos(ra), numpy.cos(dec) * numpy.sin(ra), numpy.sin(dec)))
+
+
+class _SkyGrid(object):
+    """
+    Grid of cells, one radius across, over the unit vectors of a set of targets so the targets near any one of them
+    are found by looking at the 27 cells around it, rather than at all the targets.
+    """
+
+    def __init__(self, coordinates, radius):
+        """
+        :param coordinates: SkyCoord array of the targets.
+        :param radius: Quantity, angle.
+        """
+        self.vectors = _unit_vectors(coordinates)
+        self.min_dot = numpy.cos(radius.to(units.radian).value)
+        cell_size = 2 * numpy.sin(radius.to(units.radian).value / 2.0)
+        self.cells = numpy.floor(self.vectors / cell_size).astype(int)
+        members = collections.defaultdict(list)
+        for idx, cell in enumerate(self.cells.tolist()):
+            members[tuple(cell)].append(idx)
+        self.members = dict((cell, numpy.array(indices)) for cell, indices in members.items())
+        self.offsets = [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]
+
+    def nearby(self, seed, exclude):
+        """
+        The targets within radius of seed, nearest first.  The seed is always first.
+
+        :param seed: index of the target to look around.
+        :param exclude: numpy boolean array, True for targets to leave out.
+        :return: numpy array of target indices.
+        """
+        i, j, k = self.cells[seed]
+        candidates = [self.members[(i + di, j + dj, k + dk)] for di, dj, dk in self.offsets
+                      if (i + di, j + dj, k + dk) in self.members]
+        candidates = numpy.concatenate(candidates)
+        candidates = candidates[~exclude[candidates]]
+        dots = numpy.dot(self.vectors[candidates], self.vectors[seed])
+        nearby = dots >= self.min_dot
+        candidates = candidates[nearby][numpy.argsort(-dots[nearby], kind='mergesort')]
+        # the seed is its own nearest neighbour, so it always comes first.
+        return numpy.concatenate(([seed], candidates[candidates != seed]))
+
+
+def pack_observing_groups(ob_tokens, coordinates, durations, radius=OG_RADIUS, budget=OG_TIME_BUDGET):
+    """
+    Pack OBs into OGs of nearby targets.
+
+    OGs are started from the unpacked OB with the smallest RA and filled with the unpacked OBs within radius of it,
+    nearest first, for as long as they fit in the time budget.  An OB that is longer than the budget on its own gets
+    its own OG.
+
+    :param ob_tokens: list of OB client tokens.
+    :param coordinates: SkyCoord array of the target of each OB.
+    :param durations: numpy array of the time each OB takes, in seconds, including overheads.
+    :param radius: Quantity, angle.
+    :param budget: longest OG, in seconds.
+    :return: list of PackedGroup, the OB tokens of each OG and its duration in seconds.
+    """
+    durations = numpy.asarray(durations, dtype='f8')
+    grid = _SkyGrid(coordinates, radius)
+    packed = numpy.zeros(len(ob_tokens), dtype=bool)
+    groups = []
+    for seed in numpy.argsort(coordinates.ra.radian, kind='mergesort'):
+        if packed[seed]:
+            continue
+        group = []
+        duration = 0.0
+        for idx in grid.nearby(seed, packed):
+            if group and duration + durations[idx] > budget:
+                continue
+            group.append(idx)
+            duration += durations[idx]
+        packed[group] = True
+        groups.append(PackedGroup([ob_tokens[idx] for idx in group], duration))
+    return groups
+
+
+def schedule_observing_groups(ob_tokens, coordinates, durations, windows, nrepeats=2, radius=OG_RADIUS,
+                              budget=OG_TIME_BUDGET):
+    """
+    Pack OBs into OGs of nearby targets that can be observed together, and plan the nights each OG is observed on.
+
+    An OB can be observed on the nights its target's window is at least as long as the OB.  OGs are started from
+    the unpacked OB with the fewest such nights, then the smallest RA, and filled with the unpacked OBs within radius
+    of it, nearest first, that fit in the time budget and keep a common window, as long as the OG, on as many nights
+    as the OG and its repeats need.  Each OG is planned for the nights, of those it can be observed on, that have the
+    least time planned so far, one night for the OG and one for each of its nrepeats repeats.  An OG that can be
+    observed on fewer nights gets fewer repeats.
+
+    :param ob_tokens: list of OB client tokens.
+    :param coordinates: SkyCoord array of the target of each OB.
+    :param durations: numpy array of the time each OB takes, in seconds, including overheads.
+    :param windows: list of the observable windows of the target of each OB, as dictionaries of the first and last
+    MJD the target is observable in each night, keyed by visibility.local_night.
+    :param nrepeats: number of repeats wanted for each OG.
+    :param radius: Quantity, angle.
+    :param budget: longest OG, in seconds.
+    :return: list of ScheduledGroup and the list of the tokens of the OBs that can not be scheduled.
+    """
+    durations = numpy.asarray(durations, dtype='f8')
+    usable = [dict((night, window) for night, window in target_windows.items()
+                   if (window[1] - window[0]) * SECONDS_PER_DAY >= duration)
+              for target_windows, duration in zip(windows, durations)]
+    n_nights = numpy.array([len(nights) for nights in usable])
+    unscheduled = n_nights == 0
+    grid = _SkyGrid(coordinates, radius)
+    packed = unscheduled.copy()
+    load = collections.defaultdict(float)
+    groups = []
+    for seed in numpy.lexsort((coordinates.ra.radian, n_nights)):
+        if packed[seed]:
+            continue
+        common = usable[seed]
+        required = min(nrepeats + 1, len(common))
+        group = []
+        duration = 0.0
+        for idx in grid.nearby(seed, packed):
+            if group and duration + durations[idx] > budget:
+                continue
+            overlap = {}
+            for night, (start, stop) in common.items():
+                if night not in usable[idx]:
+                    continue
+                start = max(start, usable[idx][night][0])
+                stop = min(stop, usable[idx][night][1])
+                if (stop - start) * SECONDS_PER_DAY >= duration + durations[idx]:
+                    overlap[night] = (start, stop)
+            if len(overlap) < required:
+                continue
+            common = overlap
+            group.append(idx)
+            duration += durations[idx]
+        packed[group] = True
+        nights = sorted(sorted(common, key=lambda night: (load[night], night))[:nrepeats + 1])
+        for night in nights:
+            load[night] += duration
+        groups.append(ScheduledGroup([ob_tokens[idx] for idx in group], duration, nights))
+    return groups, [ob_tokens[idx] for idx in numpy.flatnonzero(unscheduled)]
+
+
 class Program(object):
     def __init__(self, runid="17BC08", pi_login="kavelaars"):
         self.config = {"runid": runid,
@@ -41,20 +288,276 @@ class Program(object):
                                                  "observing_blocks": [],
                                                  "observing_groups": []
                                                  }}
+        # duration, in seconds, of each OG, repeats are not included.
+        self.og_durations = collections.OrderedDict()
+        self.targets = []
+        # client tokens of the repeats of each OG.
+        self.og_repeats = {}
+        # time, in seconds, planned for each night when the OGs are scheduled, keyed by visibility.local_night.
+        self.night_durations = collections.OrderedDict()
+        # names of the targets that could not be scheduled.
+        self.unscheduled = []
+
+    @property
+    def total_time(self):
+        """
+        The time needed to observe every OG once, in seconds.
+        """
+        return sum(self.og_durations.values())
 
     def add_target(self, target):
-        self.config["program_configuration"]["targets"].append(target)
+        """
+        :param target: Target, or a CFHT API target dictionary.
+        """
+        if not isinstance(target, Target):
+            target = Target(config=target)
+        self.targets.append(target)
+        self.config["program_configuration"]["targets"].append(target.config)
 
     def add_observing_block(self, observing_block):
         self.config["program_configuration"]["observing_blocks"].append(observing_block)
 
-    def add_observing_group(self, observing_group):
+    def add_observing_group(self, observing_group, repeat_tokens=()):
+        """
+        :param observing_group: OG configuration dictionary.
+        :param repeat_tokens: client tokens of repeats of the OG, the repeats are written from the same dictionary.
+        """
         self.config["program_configuration"]["observing_groups"].append(observing_group)
+        if len(repeat_tokens) > 0:
+            self.og_repeats[observing_group["identifier"]["client_token"]] = list(repeat_tokens)
+
+    def observing_groups(self):
+        """
+        Iterate over the OGs, each followed by its repeats.
+        """
+        for observing_group in self.config["program_configuration"]["observing_groups"]:
+            yield observing_group
+            for client_token in self.og_repeats.get(observing_group["identifier"]["client_token"], []):
+                yield dict(observing_group, identifier={"client_token": client_token})
+
+    def _write_item(self, f_handle, item, level):
+        prefix = "\n" + JSON_INDENT * level
+        if isinstance(item, Target):
+            target = item
+            if target.points_span is None and target.ephem_target is None:
+                item = target.config
+            else:
+                moving_target = dict(target.config["moving_target"], ephemeris_points=EPHEMERIS_POINTS_PLACEHOLDER)
+                item = dict(target.config, moving_target=moving_target)
+        text = json.dumps(item, indent=len(JSON_INDENT), sort_keys=True, separators=JSON_SEPARATORS)
+        parts = text.replace("\n", prefix).split(json.dumps(EPHEMERIS_POINTS_PLACEHOLDER))
+        f_handle.write(parts[0])
+        for part in parts[1:]:
+            f_handle.write('[')
+            target.write_points(f_handle)
+            f_handle.write(']' + part)
+
+    def _write_array(self, f_handle, items, level):
+        """
+        Write a JSON array one item at a time, laid out as json.dump would with an indent.
+        """
+        prefix = "\n" + JSON_INDENT * (level + 1)
+        f_handle.write('[')
+        empty = True
+        for item in items:
+            f_handle.write(empty and prefix or JSON_SEPARATORS[0] + prefix)
+            self._write_item(f_handle, item, level + 1)
+            empty = False
+        f_handle.write(not empty and "\n" + JSON_INDENT * level + ']' or ']')
+
+    def write(self, f_handle):
+        """
+        Write the program as JSON, a section at a time and one target, OB or OG at a time within each section.
+
+        The ephemeris points of targets read from files are copied from those files and the OG repeats are written
+        from the OG they repeat, so neither is held in memory.
+        """
+        sections = {"targets": lambda: self.targets,
+                    "observing_blocks": lambda: self.config["program_configuration"]["observing_blocks"],
+                    "observing_groups": self.observing_groups}
+        f_handle.write('{')
+        for idx, key in enumerate(sorted(self.config)):
+            f_handle.write((idx and JSON_SEPARATORS[0] or '') + "\n" + JSON_INDENT + json.dumps(key) +
+                           JSON_SEPARATORS[1])
+            if key != "program_configuration":
+                self._write_item(f_handle, self.config[key], 1)
+                continue
+            program_configuration = self.config[key]
+            f_handle.write('{')
+            for section_idx, section in enumerate(sorted(program_configuration)):
+                f_handle.write((section_idx and JSON_SEPARATORS[0] or '') + "\n" + JSON_INDENT * 2 +
+                               json.dumps(section) + JSON_SEPARATORS[1])
+                if section in sections:
+                    self._write_array(f_handle, sections[section](), 2)
+                else:
+                    self._write_item(f_handle, program_configuration[section], 2)
+            f_handle.write("\n" + JSON_INDENT + '}')
+        f_handle.write("\n}")
+
+    def save(self, filename, compress=False):
+        """
+        Write the program to filename, see write.
+
+        :param compress: gzip the file, also done when filename ends in .gz
+        """
+        if compress or filename.endswith('.gz'):
+            f_handle = gzip.open(filename, 'wb')
+        else:
+            f_handle = open(filename, 'w')
+        with f_handle:
+            self.write(f_handle)
+
+
+def _scan_target(filename):
+    """
+    Read a CFHT API target file, without reading past the first of its ephemeris points.
+
+    The file is expected to end with the ephemeris_points array, as written by ephem_target.EphemTarget.  The start of
+    the file is read up to the end of the first point and the end of the file back to the close of the array, the
+    points in between are left in the file.  Files laid out differently are loaded in full.
+
+    :return: the target as a dictionary, with only the first ephemeris point, and the (start, stop) offsets of the
+    contents of the ephemeris_points array in the file, or None if the whole file was loaded.
+    """
+    decoder = json.JSONDecoder()
+    with open(filename, 'rb') as f_handle:
+        head = ""
+        match = None
+        while match is None:
+            data = f_handle.read(READ_SIZE)
+            head += data
+            match = EPHEMERIS_POINTS_PATTERN.search(head)
+            if not data:
+                break
+        f_handle.seek(0, os.SEEK_END)
+        size = f_handle.tell()
+        f_handle.seek(max(0, size - READ_SIZE))
+        tail = f_handle.read()
+        stop = tail.rfind(']') + size - len(tail)
+        if match is None or stop < match.end() or tail[tail.rfind(']') + 1:].strip('}' + string.whitespace):
+            f_handle.seek(0)
+            return json.load(f_handle), None
+        try:
+            config = json.loads(head[:match.end()] + tail[tail.rfind(']'):])
+            points = config["moving_target"]["ephemeris_points"]
+        except (ValueError, KeyError, TypeError):
+            f_handle.seek(0)
+            return json.load(f_handle), None
+        f_handle.seek(len(head))
+        while True:
+            text = head[match.end():stop].lstrip()
+            if len(text) == 0 and len(head) >= stop:
+                # no ephemeris points.
+                break
+            try:
+                points.append(decoder.raw_decode(text)[0])
+                break
+            except ValueError:
+                data = f_handle.read(READ_SIZE)
+                if not data:
+                    raise
+                head += data
+    return config, (match.end(), stop)
 
 
 class Target(object):
-    def __init__(self, filename=None):
-        self.config = json.load(open(filename))
+    def __init__(self, filename=None, config=None, ephem_target=None):
+        """
+        :param filename: CFHT API target file, as written by ephem_target.EphemTarget.  Only the first ephemeris point
+        is loaded into config, the rest are copied from the file when the program is saved.
+        :param config: the CFHT API target, as a dictionary, instead of reading filename.
+        :param ephem_target: ephem_target.EphemTarget holding the ephemeris points, which are formatted from it when the
+        program is saved.  config then only needs the first point.
+        """
+        self.filename = filename
+        self.ephem_target = ephem_target
+        self.points_span = None
+        if config is None:
+            config, self.points_span = _scan_target(filename)
+        self.config = config
+
+    def write_points(self, f_handle):
+        """
+        Copy the ephemeris points, the contents of the ephemeris_points array, from the target file to f_handle.
+        """
+        if self.ephem_target is not None:
+            points = self.ephem_target.points
+            for start in range(0, len(points), ROWS_PER_WRITE):
+                if start > 0:
+                    f_handle.write(JSON_SEPARATORS[0])
+                block = points[start:start + ROWS_PER_WRITE]
+                f_handle.write(self.ephem_target._cfht_api_points(block, *JSON_SEPARATORS))
+            return
+        if self.points_span is None:
+            f_handle.write(",".join(json.dumps(point) for point in self.config["moving_target"]["ephemeris_points"]))
+            return
+        start, stop = self.points_span
+        with open(self.filename, 'rb') as source:
+            source.seek(start)
+            while start < stop:
+                data = source.read(min(READ_SIZE, stop - start))
+                if not data:
+                    break
+                f_handle.write(data)
+                start += len(data)
+
+    def epochs(self):
+        """
+        The MJD of each ephemeris point, scanned from the target file when the points were left in it.
+
+        :return: numpy array
+        """
+        if self.ephem_target is not None:
+            # to the precision the points are written with.
+            return numpy.round(numpy.array(self.ephem_target.points['mjd'], dtype='f8'), 5)
+        if self.points_span is None:
+            return numpy.array([float(point["epoch_millis"])
+                                for point in self.config["moving_target"]["ephemeris_points"]])
+        epochs = []
+        start, stop = self.points_span
+        text = ""
+        with open(self.filename, 'rb') as source:
+            source.seek(start)
+            while start < stop:
+                data = source.read(min(READ_SIZE, stop - start))
+                if not data:
+                    break
+                start += len(data)
+                text += data
+                # the epochs before the close of a point are complete.
+                end = start < stop and text.rfind('}') + 1 or len(text)
+                epochs.extend(EPOCH_PATTERN.findall(text, 0, end))
+                text = text[end:]
+        return numpy.array(epochs, dtype='f8')
+
+    def windows(self, observatory=None):
+        """
+        The times the target is observable in each night, from its ephemeris points.
+
+        Each point stands for one step of the ephemeris, so a night's window reaches half a step before its first
+        point and half a step after its last, and a night with a single point is one step long.  The step is the
+        closest spacing of the points within a night, or DEFAULT_EPHEMERIS_STEP if no night has two points.
+
+        :param observatory: ephem.Observer, defaults to CFHT.
+        :return: dictionary of the (first, last) MJD keyed by visibility.local_night.
+        """
+        epochs = self.epochs()
+        nights, first, last = visibility.nightly_windows(epochs, observatory)
+        gaps = numpy.diff(epochs)[numpy.diff(visibility.local_night(epochs, observatory)) == 0]
+        step = len(gaps) > 0 and gaps.min() or DEFAULT_EPHEMERIS_STEP
+        return dict(zip(nights.tolist(), zip((first - step / 2).tolist(), (last + step / 2).tolist())))
+
+    @classmethod
+    def from_ephem_target(cls, ephem_target):
+        """
+        The Target for an ephem_target.EphemTarget, without writing it to a file.  Only the first ephemeris point is
+        put in config, the rest are formatted straight from ephem_target when the program is saved.
+        """
+        first = ephem_target._cfht_api_points(ephem_target.points[:1], *JSON_SEPARATORS)
+        config = {"identifier": {"client_token": "{}-{}".format(ephem_target.runid, ephem_target.name)},
+                  "name": ephem_target.name,
+                  "moving_target": {"ephemeris_points": json.loads("[{}]".format(first))}}
+        return cls(config=config, ephem_target=ephem_target)
 
     @property
     def name(self):
@@ -96,11 +599,132 @@ class ObservingGroup(object):
         self.config["observing_block_identifiers"].append({"client_token": client_token})
 
 
+def build_program(targets, runid, qrunid, pi_login="kavelaars", nrepeats=2, radius=OG_RADIUS,
+                  budget=OG_TIME_BUDGET, schedule=False, observatory=None):
+    """
+    Build the PH2 program that observes each target: an OB per target, with the instrument configuration set by
+    the target's magnitude, packed into OGs of nearby targets that are each repeated nrepeats more times.
+
+    When schedule is set the OGs are instead built from targets that can be observed together on the same nights,
+    as read from the times of their ephemeris points, and repeated on as many of those nights as there are, up to
+    nrepeats, see schedule_observing_groups.  The time planned for each night is kept in the program's
+    night_durations and the targets that can not be scheduled are left out of the program and listed in its
+    unscheduled.
+
+    :param targets: list of Target, ephem_target.EphemTarget or CFHT API target dictionaries.
+    :param runid: CFHT run the program is for.
+    :param qrunid: queue run, used to name the OBs and OGs.
+    :param pi_login: CFHT login of the PI.
+    :param nrepeats: number of repeats of each OG, for tracking.
+    :param radius: Quantity, largest distance of an OB from the first OB of its OG.
+    :param budget: longest OG, in seconds.
+    :param schedule: build the OGs from the visibility windows of the targets.
+    :param observatory: ephem.Observer, defaults to CFHT, sets the local nights when scheduling.
+    :return: Program
+    """
+    program = Program(runid, pi_login=pi_login)
+    programmed = []
+    ob_tokens = []
+    mags = []
+    coordinates = []
+    for target in targets:
+        if isinstance(target, dict):
+            target = Target(config=target)
+        elif not isinstance(target, Target):
+            target = Target.from_ephem_target(target)
+        try:
+            mag = target.mag
+            coordinate = target.coordinate
+        except IndexError:
+            logging.warning("Skipping {} which has no ephemeris points.".format(target.name))
+            continue
+        logging.info("Programming: {} V:{}".format(target.name, mag))
+        if mag is None or not numpy.isfinite(mag):
+            mag = 25.0
+        programmed.append(target)
+        ob_tokens.append("OB-{}-{}".format(qrunid, target.token))
+        mags.append(mag)
+        coordinates.append(coordinate)
+
+    if len(ob_tokens) == 0:
+        return program
+
+    # Set the IC of all the OBs at once.
+    exptimes, identifiers = instrument_configurations(mags)[1:]
+    durations = exptimes + OB_OVERHEAD
+    coordinates = SkyCoord(coordinates)
+
+    if schedule:
+        groups, unscheduled = schedule_observing_groups(ob_tokens, coordinates, durations,
+                                                        [target.windows(observatory) for target in programmed],
+                                                        nrepeats=nrepeats, radius=radius, budget=budget)
+        unscheduled = set(unscheduled)
+        for target, ob_token in zip(programmed, ob_tokens):
+            if ob_token in unscheduled:
+                logging.warning("Can not schedule {}, it is not observable for long enough on any night.".format(
+                    target.name))
+                program.unscheduled.append(target.name)
+    else:
+        # Pack the OBs into OGs of nearby targets.
+        groups = pack_observing_groups(ob_tokens, coordinates, durations, radius=radius, budget=budget)
+        unscheduled = set()
+
+    for target, ob_token, identifier in zip(programmed, ob_tokens, identifiers):
+        if ob_token in unscheduled:
+            continue
+        program.add_target(target)
+        ob = ObservingBlock(ob_token, target.token)
+        ob.config["instrument_config_identifiers"] = [{"server_token": identifier}]
+        program.add_observing_block(ob.config)
+
+    # start the OG index at 1.
+    for og_idx, group in enumerate(groups, 1):
+        og_token = "OG_{}_{}_{}_{}".format(runid, qrunid, og_idx, 0)
+        og = ObservingGroup(og_token)
+        for ob_token in group.ob_tokens:
+            og.add_ob(ob_token)
+        repeats = nrepeats
+        if schedule:
+            repeats = len(group.nights) - 1
+        program.add_observing_group(og.config, repeat_tokens=["OG_{}_{}_{}_{}".format(runid, qrunid, og_idx,
+                                                                                      repeat + 1)
+                                                              for repeat in range(repeats)])
+        program.og_durations[og_token] = group.duration
+        if schedule:
+            for night in group.nights:
+                program.night_durations[night] = program.night_durations.get(night, 0.0) + group.duration
+    if schedule:
+        program.night_durations = collections.OrderedDict(sorted(program.night_durations.items()))
+        logging.info("Total integration time {}s".format(sum(program.night_durations.values())))
+    else:
+        logging.info("Total integration time {}s".format(program.total_time * (nrepeats + 1)))
+    return program
+
+
+def write_report(program, f_handle):
+    """
+    Write the duration of each OG and, when the program was scheduled, the time planned for each night and the
+    targets that could not be scheduled.
+    """
+    for og_token, og_itime in program.og_durations.items():
+        f_handle.write("OG {} is {}s in duration.\n".format(og_token, og_itime))
+    for night, itime in program.night_durations.items():
+        f_handle.write("Night of {} has {}s of integration.\n".format(visibility.night_label(night), itime))
+    for name in program.unscheduled:
+        f_handle.write("Target {} can not be scheduled.\n".format(name))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('runid')
     parser.add_argument('qrunid')
     parser.add_argument('targets', nargs='+')
+    parser.add_argument('--gzip', help="Write the PH2 file gzip compressed.", action="store_true", default=False)
+    parser.add_argument('--exposure-config', help="JSON file of the exposure time table, see load_exposure_config.",
+                        default=None)
+    parser.add_argument('--nrepeats', help="Number of repeats of each observing group.", default=2, type=int)
+    parser.add_argument('--schedule', help="Build observing groups of targets that are observable on the same "
+                                           "nights.", action="store_true", default=False)
     parser.add_argument('--verbose', help="Verbose message reporting.", action="store_true", default=False)
     parser.add_argument('--debug', help="Provide debuging information.", action="store_true", default=False)
     args = parser.parse_args()
@@ -111,70 +735,9 @@ if __name__ == "__main__":
         logging.basicConfig(level=logging.INFO)
     logging.basicConfig(level=logging.ERROR)
 
-    program = Program(args.runid, pi_login="kavelaars")
-    ob_tokens = []
-    mags = {}
-    ob_coordinate = {}
-    for filename in args.targets:
-        target = Target(filename)
-        logging.info("Programming: {} V:{}".format(target.name, target.mag))
-        try:
-            mag = target.mag
-        except:
-            mag = 25.0
-        program.add_target(target.config)
-        ob_token = "OB-{}-{}".format(args.qrunid, target.token)
-        ob = ObservingBlock(ob_token, target.token)
-        idx = instrument_configuration_identifier(mag)
-        ob.config["instrument_config_identifiers"] = [{"server_token": "I{}".format(idx)}]
-        program.add_observing_block(ob.config)
-        ob_tokens.append(ob_token)
-        mags[ob_token] = mag
-        ob_coordinate[ob_token] = target.coordinate
-
-    # Order the tokens by RA of the target.
-    sf = lambda x, y: cmp(x.ra, y.ra)
-    order_tokens = sorted(ob_coordinate, cmp=sf, key=ob_coordinate.get)
-
-    # Keep track of total observing time, which OGs have been built and which OBs are in an OG.
-    total_itime = 0
-    ogs = {}
-    scheduled = {}
-
-    # start the OG index at 1.
-    og_idx = 0
-    while len(scheduled) < len(ob_tokens):
-        og_idx += 1
-        og_coord = None
-        og_itime = 0
-        repeat = 0
-        og_token = "OG_{}_{}_{}_{}".format(args.runid, args.qrunid, og_idx, repeat)
-        og = ObservingGroup(og_token)
-
-        for ob_token in order_tokens:
-            if ob_token not in scheduled:
-                if og_coord is None:
-                    og_coord = ob_coordinate[ob_token]
-                if ob_coordinate[ob_token].separation(og_coord) > 10 * units.degree:
-                    # Skip over targets that are more that 10 degrees away.
-                    # They get their own OG.
-                    continue
-                og.add_ob(ob_token)
-                scheduled[ob_token] = True
-                og_itime += exposure_time(mags[ob_token]) + 40
-                if og_itime > 3000.0:
-                    break
-                break
-
-        total_itime += og_itime
-        sys.stdout.write("OG {} is {}s in duration.\n".format(og_token, og_itime))
-        program.add_observing_group(og.config)
-        nrepeats = 2  # do each OG twice, for tracking.
-        for repeat in range(nrepeats):
-            total_itime += og_itime
-            og_token = "OG_{}_{}_{}_{}".format(args.runid, args.qrunid, og_idx, repeat+1)
-            og = copy.deepcopy(og)
-            og.config["identifier"]["client_token"] = og_token
-            program.add_observing_group(og.config)
-
-    json.dump(program.config, open('PH2_{}_{}.json'.format(args.runid, args.qrunid), 'w'), indent=4, sort_keys=True)
+    if args.exposure_config is not None:
+        load_exposure_config(args.exposure_config)
+    program = build_program([Target(filename) for filename in args.targets], args.runid, args.qrunid,
+                            nrepeats=args.nrepeats, schedule=args.schedule)
+    write_report(program, sys.stdout)
+    program.save('PH2_{}_{}.json{}'.format(args.runid, args.qrunid, args.gzip and '.gz' or ''))
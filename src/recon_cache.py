@@ -0,0 +1,163 @@
+"""
+A persistent on-disk cache of the RECON candidate lists.
+
+Each list is stored as fetched, along with the ETag and Last-Modified validators the server sent for it, so fetching
+a list again is a conditional GET that only transfers the page when it has changed.  The lists are fetched over a
+single pooled requests.Session, several at a time.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'cfht_mp_tracking', 'recon')
+# seconds to wait for the server to connect and to send data.
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_MAX_WORKERS = 4
+
+
+class ReconListCache(object):
+    """
+    Fetch RECON lists through a directory of cached pages, revalidating each with the server.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, timeout=DEFAULT_TIMEOUT, enabled=True, refresh=False,
+                 max_workers=DEFAULT_MAX_WORKERS, session=None):
+        """
+        :param directory: where the cached lists are stored.
+        :param timeout: seconds to wait for the server before giving up, a cached copy is used when there is one.
+        :param enabled: when False every list is fetched in full and nothing is stored.
+        :param refresh: when True every list is fetched in full and replaces the cached copy.
+        :param max_workers: number of lists fetched at once, and the number of pooled connections.
+        :param session: requests.Session to fetch through, one with a connection pool is made if not given.
+        """
+        self.directory = directory
+        self.timeout = timeout
+        self.enabled = enabled
+        self.refresh = refresh
+        self.max_workers = max_workers
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def filename(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """
+        Look up a cached list.
+
+        :return: (content, validators) where validators is a dictionary of the etag and last_modified headers sent
+        with the content, or None if the list is not cached.
+        """
+        filename = self.filename(url)
+        try:
+            with open(filename + '.json') as f_handle:
+                validators = json.load(f_handle)
+            with open(filename + '.html', 'rb') as f_handle:
+                content = f_handle.read()
+        except (IOError, OSError, ValueError):
+            return None
+        return content, validators
+
+    def put(self, url, content, validators):
+        """
+        Store a list and the validators sent with it.
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        filename = self.filename(url)
+        # write to unique files and rename them into place, so concurrent fetches never see a partial entry.
+        for suffix, data in (('.html', content), ('.json', json.dumps(dict(validators, url=url)))):
+            handle, partial = tempfile.mkstemp(suffix='.part', dir=self.directory)
+            with os.fdopen(handle, 'wb') as f_handle:
+                f_handle.write(data)
+            os.rename(partial, filename + suffix)
+
+    def fetch(self, url):
+        """
+        Get the content of the list at url, from the cache when the server reports it has not changed.
+
+        :param url: http(s) URL of the list, or the name of a local file which is read directly.
+        :return: str, the page as sent by the server.
+        """
+        if not url.startswith('http'):
+            with open(url, 'rb') as f_handle:
+                return f_handle.read()
+        cached = None
+        headers = {}
+        if self.enabled and not self.refresh:
+            cached = self.get(url)
+        if cached is not None:
+            if cached[1].get('etag'):
+                headers['If-None-Match'] = cached[1]['etag']
+            if cached[1].get('last_modified'):
+                headers['If-Modified-Since'] = cached[1]['last_modified']
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and cached is not None:
+                logging.debug("Using cached copy of {}, it has not changed.".format(url))
+                return cached[0]
+            response.raise_for_status()
+        except requests.RequestException as ex:
+            if cached is None:
+                raise
+            logging.warning("Using cached copy of {}, fetching it failed: {}".format(url, ex))
+            return cached[0]
+        logging.debug("Fetched {}".format(url))
+        if self.enabled:
+            self.put(url, response.content, {'etag': response.headers.get('ETag'),
+                                             'last_modified': response.headers.get('Last-Modified')})
+        return response.content
+
+    def fetch_all(self, urls):
+        """
+        Fetch several lists at once.
+
+        :param urls: list of URLs, see fetch.
+        :return: OrderedDict of the content of each list, keyed and ordered by url.
+        """
+        urls = list(OrderedDict.fromkeys(urls))
+        if len(urls) <= 1:
+            return OrderedDict((url, self.fetch(url)) for url in urls)
+        pool = ThreadPool(min(self.max_workers, len(urls)))
+        try:
+            return OrderedDict(zip(urls, pool.map(self.fetch, urls)))
+        finally:
+            pool.close()
+            pool.join()
+
+
+def add_cache_arguments(parser):
+    """
+    Add the options that configure the RECON list cache to an argparse parser.
+    """
+    parser.add_argument('--no-list-cache', help="Always fetch the RECON lists in full and do not store them.",
+                        action="store_true", default=False)
+    parser.add_argument('--refresh-lists', help="Fetch the RECON lists in full and replace any cached copies.",
+                        action="store_true", default=False)
+    parser.add_argument('--list-cache-directory', help="Directory holding cached RECON lists.",
+                        default=DEFAULT_CACHE_DIRECTORY)
+    parser.add_argument('--timeout', help="Seconds to wait for the RECON server.", default=DEFAULT_TIMEOUT,
+                        type=float)
+
+
+def cache_from_args(args):
+    """
+    Build the ReconListCache described by the options from add_cache_arguments.
+    """
+    return ReconListCache(directory=args.list_cache_directory,
+                          timeout=args.timeout,
+                          enabled=not args.no_list_cache,
+                          refresh=args.refresh_lists)
@@ -12,12 +12,20 @@ from astropy.time import Time
 from astropy import units
 from astropy.table import Table
 from datetime import datetime
+from collections import OrderedDict
 from cStringIO import StringIO
 import numpy
 import ephem
 import math
 import logging
-from mp_ephem import horizons
+import visibility
+import horizons_cache
+import recon_cache
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
 
 DESCRIPTION = """Connects to the web server at SWRI to retrieve various lists of occultation and apulse predictions.
 Parses through the table on those pages to deliver a list of targets that would be suitable for tracking with CFHT
@@ -25,6 +33,8 @@ during the given time period.
 """
 
 MINIMUM_UP_TIME = 1.0 * units.hour
+# Spacing of the times candidates are checked for being up at.
+USABLE_HOURS_STEP = 10 * units.minute
 DES_CLASSES = ['CENTAURR',
                'ERR2LARGE',
                'RESONANT',
@@ -40,16 +50,76 @@ ORB_CLASS = 'DES Classification'
 EPHEM_UNCERTAINTY = 'TNO pos err'
 EVENT_TIME = "ET"
 
+# The sources of the recon tno lists, as pages of the service.
+EVENT_LIST_PAGE = {}
+
+# allevents.html lists the best candidates for TNO occultation for the next two years
+# without regard for observing location.
+# Adding some observations might raise the probability of an event for one of these.
+EVENT_LIST_PAGE['all'] = "allevents.html"
+
+# reconlist contains the best candidates for TNO occultation
+# for the next two years that are visible from the entire network.
+#  These events all have a minimum success probability of 30%.
+#  Near term observation will help confirm the probability
+EVENT_LIST_PAGE['best'] = "reconlist.html"
+
+# reconwatch.html lists the candidates for TNO occultation for the next
+# two years that are visible from the entire network.
+# observations in the near term will help firm up the occultation probabilities.
+EVENT_LIST_PAGE['watch'] = "reconwatch.html"
+
+# longlist.html This is a list of TNOs with current positional errors between 2 and 240 arcseconds.
+# These objects are easy to find but have errors too large to permit useful
+# predictions of occultation opportunities.
+EVENT_LIST_PAGE['long'] = "longlist.html"
+
+EVENT_LISTS = ['all', 'best', 'watch', 'long']
+EVENT_LIST_URL = dict((name, "{}/{}".format(SERVICE_URL, page)) for name, page in EVENT_LIST_PAGE.items())
+
+# there is also a CSV list, but its everything bunched together.
+# url = "http://www.boulder.swri.edu/~buie/recon/reconlist.csv"
+
 
 class HTMLTableParser(object):
-    """A Parser for an HTML Table, based on example from the BeautifulSoup cookbook."""
+    """A Parser for an HTML Table, based on example from the BeautifulSoup cookbook.
+
+    Pages are parsed with lxml when it is installed, and with BeautifulSoup's html5lib backend otherwise.
+    """
 
     def parse_url(self, url):
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, 'html5lib')
+        response = requests.get(url, timeout=recon_cache.DEFAULT_TIMEOUT)
+        return self.parse_text(response.content)
+
+    def parse_text(self, text):
+        """
+        Parse every table in an HTML page.
+
+        :param text: the page.
+        :return: list of (table id, pandas dataframe)
+        """
+        if lxml_html is not None:
+            try:
+                document = lxml_html.document_fromstring(text)
+            except (ValueError, etree.ParserError) as ex:
+                logging.debug("lxml failed to parse the page, using html5lib: {}".format(ex))
+            else:
+                return [(table.get('id', ''), self.parse_lxml_table(table)) for table in document.iter('table')]
+        soup = BeautifulSoup(text, 'html5lib')
         return [(table.get('id', ''), self.parse_html_table(table)) \
                 for table in soup.find_all('table')]
 
+    def parse_lxml_table(self, table):
+        """
+        Parse the given HTML Table, as parsed by lxml.
+
+        :param table: lxml.html element
+        :return: pandas dataframe
+        """
+        return self.build_data_frame(([unicode(th.text_content()) for th in row.iter('th')],
+                                      [unicode(td.text_content()) for td in row.iter('td')])
+                                     for row in table.iter('tr'))
+
     def parse_html_table(self, table):
         """
         Parse the given HTML Table DOM.
@@ -57,102 +127,71 @@ class HTMLTableParser(object):
         :param table:
         :return: pandas dataframe
         """
+        return self.build_data_frame(([th.get_text() for th in row.find_all('th')],
+                                      [td.get_text() for td in row.find_all('td')])
+                                     for row in table.find_all('tr'))
+
+    @staticmethod
+    def build_data_frame(rows):
+        """
+        Build the dataframe of a table from the text of its rows, in a single pass over the rows.
+
+        The column names are the <th> of the first row that has them, or the <td> of the first row if no row
+        before the data has any <th>.  Columns that hold only numbers are converted to float.
 
+        :param rows: iterable of the (<th> texts, <td> texts) of each <tr>.
+        :return: pandas dataframe
+        """
         n_columns = 0
-        n_rows = 0
         column_names = []
-        skip_first_tr = False
-        # Find number of rows and columns
-        # we also find the column titles if we can
-        for row in table.find_all('tr'):
-            # Determine the number of rows in the table
-            td_tags = row.find_all('td')
-            if len(td_tags) > 0:
-                n_rows += 1
-            if n_columns == 0:
-                # Set the number of columns for our table
-                n_columns = len(td_tags)
-
-                # Handle column names if we find them
-            th_tags = row.find_all('th')
-            if len(th_tags) > 0 and len(column_names) == 0:
-                for th in th_tags:
-                    column_names.append(th.get_text())
-                skip_first_tr = False
-            # Assume first row is names as <td> objects if not set
+        cells = []
+        for th_texts, td_texts in rows:
             if len(column_names) == 0:
-                td_tags = row.find_all('td')
-                for td in td_tags:
-                    column_names.append(td.get_text())
-                n_rows -= 1
-                skip_first_tr = True
+                if len(th_texts) > 0:
+                    column_names = th_texts
+                else:
+                    # Assume first row is names as <td> objects if not set
+                    column_names = td_texts
+                    n_columns = n_columns or len(td_texts)
+                    continue
+            if len(td_texts) > 0:
+                cells.append(td_texts)
+                n_columns = n_columns or len(td_texts)
 
         # Safeguard on Column Titles
         if len(column_names) > 0 and len(column_names) != n_columns:
             raise Exception("Column titles do not match the number of columns")
 
         columns = column_names if len(column_names) > 0 else range(0, n_columns)
-        df = pd.DataFrame(columns=columns,
-                          index=range(0, n_rows))
-        row_marker = 0
-        for row in table.find_all('tr'):
-            if skip_first_tr:
-                skip_first_tr = False
-                continue
-            column_marker = 0
-            columns = row.find_all('td')
-            for column in columns:
-                df.iat[row_marker, column_marker] = column.get_text()
-                column_marker += 1
-            if len(columns) > 0:
-                row_marker += 1
-
-        # Convert to float if possible
-        for col in df:
+        if n_columns == 0:
+            return pd.DataFrame(columns=columns, index=range(0, len(cells)))
+
+        series = []
+        for column_marker in range(n_columns):
+            values = pd.Series([row[column_marker] if len(row) > column_marker else numpy.nan for row in cells],
+                               index=range(0, len(cells)), dtype=object)
+            # Convert to float if possible
             try:
-                df[col] = df[col].astype(float)
+                values = values.astype(float)
             except ValueError:
                 pass
+            series.append(values)
+        df = pd.concat(series, axis=1)
+        df.columns = columns
         return df
 
 
-def main():
-
-    # Configure the source of the recon tno lists.
-    event_list_url = {}
-
-    # allevents.html lists the best candidates for TNO occultation for the next two years
-    # without regard for observing location.
-    # Adding some observations might raise the probability of an event for one of these.
-    event_list_url['all'] = "{}/allevents.html".format(SERVICE_URL)
-
-    # reconlist contains the best candidates for TNO occultation
-    # for the next two years that are visible from the entire network.
-    #  These events all have a minimum success probability of 30%.
-    #  Near term observation will help confirm the probability
-    event_list_url['best'] = "{}/reconlist.html".format(SERVICE_URL)
-
-    # reconwatch.html lists the candidates for TNO occultation for the next
-    # two years that are visible from the entire network.
-    # observations in the near term will help firm up the occultation probabilities.
-    event_list_url['watch'] = "{}/reconwatch.html".format(SERVICE_URL)
-
-    # longlist.html This is a list of TNOs with current positional errors between 2 and 240 arcseconds.
-    # These objects are easy to find but have errors too large to permit useful
-    # predictions of occultation opportunities.
-    event_list_url['long'] = "{}/longlist.html".format(SERVICE_URL)
-
-    # there is also a CSV list, but its everything bunched together.
-    # url = "http://www.boulder.swri.edu/~buie/recon/reconlist.csv"
-
+def add_selection_arguments(parser):
+    """
+    Add the options that select the RECON list and candidates to an argparse parser.
+    """
+    parser.add_argument('--list', nargs='+', help="Which recon candidate lists do you want to check? Targets in "
+                                                  "more than one list are only checked once.",
+                        choices=EVENT_LISTS,
+                        default=['all'])
+    parser.add_argument('--service-url', help="Where the recon candidate lists are served from.",
+                        default=SERVICE_URL)
     # These are the classes of TNOs that are in the Buie classification.
-
-    parser = argparse.ArgumentParser(description=DESCRIPTION)
-    parser.add_argument('--verbose', help="Verbose message reporting.", action="store_true", default=False)
-    parser.add_argument('--debug', help="Provide debuging information.", action="store_true", default=False)
-    parser.add_argument('--list', help="Which recon candidate list do you want to check?",
-                        choices=['all', 'best', 'watch', 'long'],
-                        default='all')
     parser.add_argument('--classes', nargs='*',
                         help='List of classes of objects to select',
                         default=['ERR2LARGE',
@@ -164,8 +203,31 @@ def main():
                         help="Minimum uncertainty in orbit required to trigger tracking (in arsec)",
                         default=0.1,
                         type=float)
+    recon_cache.add_cache_arguments(parser)
+
+
+def list_urls(lists, service_url=SERVICE_URL):
+    """
+    The URLs of RECON lists.
+
+    :param lists: names of lists, from EVENT_LISTS.
+    :param service_url: where the lists are served from.
+    :return: list of URLs
+    """
+    return ["{}/{}".format(service_url.rstrip('/'), EVENT_LIST_PAGE[name]) for name in lists]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--verbose', help="Verbose message reporting.", action="store_true", default=False)
+    parser.add_argument('--debug', help="Provide debuging information.", action="store_true", default=False)
+    add_selection_arguments(parser)
     parser.add_argument('start_time', help="Start of period to look for events.", type=Time)
     parser.add_argument('stop_time', help="End of period to check for events.", type=Time)
+    parser.add_argument('--usable-hours', help="Write the hours each candidate is usable in each night to this CSV "
+                                               "file.", default=None)
+    horizons_cache.add_cache_arguments(parser)
     args = parser.parse_args()
 
     if args.debug:
@@ -174,43 +236,62 @@ def main():
         logging.basicConfig(level=logging.INFO)
     logging.basicConfig(level=logging.ERROR)
 
-    url = event_list_url[args.list]
+    urls = list_urls(args.list, args.service_url)
+    lists = dict(zip(urls, args.list))
 
-    logging.info("Working on events in list: {}".format(url))
-    for target in parse_recon_table(url, start_time=args.start_time, end_time=args.stop_time,
-                                    orbit_classes=args.classes, min_uncertainty=args.min_uncertainty):
-        sys.stdout.write("{}\t{}\t{}\t{}\n".format(target.name, target.mag, target.ra, target.dec))
+    logging.info("Working on events in lists: {}".format(", ".join(urls)))
+    found_in = {}
+    targets, hours = select_candidates(urls, start_time=args.start_time, end_time=args.stop_time,
+                                       orbit_classes=args.classes, min_uncertainty=args.min_uncertainty,
+                                       cache=horizons_cache.cache_from_args(args),
+                                       list_cache=recon_cache.cache_from_args(args), found_in=found_in)
+    if args.usable_hours is not None:
+        hours.write(args.usable_hours, format='ascii.csv', overwrite=True)
+    for target in targets:
+        sys.stdout.write("{}\t{}\t{}\t{}\t{}\n".format(target.name, target.mag, target.ra, target.dec,
+                                                        ",".join(lists[url] for url in found_in[target.name])))
 
 
-def parse_recon_table(url, start_time, end_time, orbit_classes, min_uncertainty):
-    """Parse the HTML tables distributed by the RECON project.
+def read_recon_tables(urls, list_cache=None):
+    """
+    Fetch and parse RECON lists, fetching them all at once.
 
+    :param urls: list of URLs (or local files) of HTML or CSV lists.
+    :param list_cache: recon_cache.ReconListCache to fetch the lists through.
+    :return: OrderedDict of astropy Table, keyed by url
     """
+    if list_cache is None:
+        list_cache = recon_cache.ReconListCache()
 
     # there are some differences in the column used by reconlist.csv and the other lists.
     col_name_mapping = {'Object ID': OBJ_ID,
                         'Type': ORB_CLASS,
                         'PosErr': EPHEM_UNCERTAINTY}
 
-    good_targets = []
-
-    if url.endswith('html'):
-        hp = HTMLTableParser()
-        ptable = hp.parse_url(url)[0][1]
-        table = Table.from_pandas(ptable)
-    else:
-        if url.startswith('http'):
-            fobj = StringIO(requests.get(url).content)
+    tables = OrderedDict()
+    for url, content in list_cache.fetch_all(urls).items():
+        if url.endswith('html'):
+            hp = HTMLTableParser()
+            ptable = hp.parse_text(content)[0][1]
+            table = Table.from_pandas(ptable)
         else:
-            fobj = open(url)
-        fobj.seek(0)
-        table = Table.read(fobj, format='csv')
+            table = Table.read(StringIO(content), format='csv')
+
+        # Some of the files have different column names
+        for old_name in col_name_mapping:
+            if old_name in table.colnames:
+                table.rename_column(old_name, col_name_mapping[old_name])
+        tables[url] = table
+    return tables
 
-    # Some of the files have different column names
-    for old_name in col_name_mapping:
-        if old_name in table.colnames:
-            table.rename_column(old_name, col_name_mapping[old_name])
 
+def select_rows(table, start_time, end_time, orbit_classes, min_uncertainty):
+    """
+    Select the rows of a RECON list for objects of orbit_classes with large enough position uncertainties, and that
+    have events between start_time and end_time, for lists of events.
+
+    :return: astropy Table
+    """
     for row in table:
         if row[ORB_CLASS] not in DES_CLASSES:
             row[ORB_CLASS] = DEFAULT_ORB_CLASS
@@ -234,92 +315,149 @@ def parse_recon_table(url, start_time, end_time, orbit_classes, min_uncertainty)
     else:
         table[EVENT_TIME] = Time(str(date.today())).iso
 
-    table = table[cond]
+    return table[cond]
 
-    cfht = ephem.Observer()
-    cfht.lat = 0.344
-    cfht.lon = -2.707
-    cfht.elevation = 4100
-    cfht.date = '2017/10/13 20:00:00'
-    cfht.date = start_time.iso.replace("-", "/")
-    cfht.horizon = math.radians(-7)
 
-    sun_set_time = Time(str(ephem.Sun(cfht).set_time).replace("/", "-"), scale='utc')
-    sun_rise_time = Time(str(ephem.Sun(cfht).rise_time).replace("/", "-"), scale='utc')
+def designation(obj_id):
+    """
+    The Horizons designation of a RECON object id, a number or a packed provisional designation.
+    """
+    try:
+        return "{:.0f}".format(float(obj_id.split()[0]))
+    except ValueError as ve:
+        logging.debug(str(ve))
+        if float(obj_id[0:2]) < 19:
+            century = 20
+        else:
+            century = 19
+        return '{}{} {}'.format(century, obj_id[0:2], obj_id[2:])
 
-    cfht.horizon = MINIMUM_ELEVATION.to('radian').value
 
-    logging.info("Table at {} contains {} matching entries.".format(url, len(table)))
+def candidate_hours(names, ephemerides, start_time, end_time, twilight, observatory=None,
+                    step_size=USABLE_HOURS_STEP):
+    """
+    Tabulate the hours each candidate is usable, above MINIMUM_ELEVATION while the Sun is down, in every night from
+    start_time to end_time, following each candidate along its ephemeris.
+
+    :param names: list of the candidate names.
+    :param ephemerides: list of the horizons_cache ephemeris of each candidate.
+    :param twilight: visibility.TwilightTable covering start_time to end_time.
+    :param observatory: ephem.Observer, defaults to CFHT.
+    :param step_size: Quantity, spacing of the times the candidates are checked at.
+    :return: astropy Table with the name of each candidate and a column of usable hours for each night, named by
+    the date the night starts on.
+    """
+    times = visibility.time_grid(start_time, end_time, step_size)
+    ra = numpy.zeros((len(names), len(times)))
+    dec = numpy.zeros((len(names), len(times)))
+    for idx, ephemeris in enumerate(ephemerides):
+        # unwrap the RA so the interpolation does not sweep back across the sky at 0h.
+        ra[idx] = numpy.interp(times.jd, ephemeris['jd'], numpy.degrees(numpy.unwrap(numpy.radians(ephemeris['ra']))))
+        dec[idx] = numpy.interp(times.jd, ephemeris['jd'], ephemeris['dec'])
+    hours = visibility.usable_hours(times, ra, dec, twilight, observatory, min_elevation=MINIMUM_ELEVATION)
+    table = Table()
+    table['name'] = numpy.array(names, dtype=str)
+    for idx, night in enumerate(visibility.local_night(twilight.sunset, observatory)):
+        table[visibility.night_label(night)] = hours[:, idx]
+        table[visibility.night_label(night)].format = '.2f'
+    return table
+
+
+def select_candidates(url, start_time, end_time, orbit_classes, min_uncertainty, twilight=None, cache=None,
+                      list_cache=None, found_in=None):
+    """Select the RECON candidates that can be tracked from CFHT between start_time and end_time.
+
+    Candidates are kept if they are usable for at least MINIMUM_UP_TIME in any one night of the period.
+
+    :param url: URL of a RECON list, or a list of them, which are merged with each object only checked once.
+    :param twilight: visibility.TwilightTable covering start_time to end_time, computed here if not given.
+    :param cache: horizons_cache.HorizonsCache to fetch the Horizons ephemerides through.
+    :param list_cache: recon_cache.ReconListCache to fetch the lists through.
+    :param found_in: dictionary that is filled with the URLs of the lists each object was selected from, by name.
+    :return: list of ephem.FixedBody, at their position at the start of the period, and the candidate_hours table of
+    every candidate in the lists.
+    """
 
-    count = 0
-    for row in table:
-        target = ephem.FixedBody()
-        count += 1
-        try:
-            name = "{:.0f}".format(float(row[OBJ_ID].split()[0]))
-        except ValueError as ve:
-            logging.debug(str(ve))
-            if float(row[OBJ_ID][0:2]) < 19:
-                century = 20
-            else:
-                century = 19
-            name = '{}{} {}'.format(century, row[OBJ_ID][0:2], row[OBJ_ID][2:])
-        logging.info("Doing object {} from row: {}".format(name, count))
-
-        # we reload the module each time as this starts a new connection to the service, otherwise the service throttles
-        reload(horizons)
-        o = horizons.Body(name, start_time=start_time, stop_time=end_time, center='568')
-        o.predict(sun_set_time)
-        logging.debug("Getting coordinates from Horizons.")
-        target._ra = o.coordinate.ra.radian
-        target._dec = o.coordinate.dec.radian
-        target.name = name
-        target.mag = o.mag
-        target.compute(cfht)
-        target_rise_time = Time(str(target.rise_time).replace("/", "-"), scale='utc')
-        target_set_time = Time(str(target.set_time).replace("/", "-"), scale='utc')
-
-        start = end = None
-        if target_rise_time > sun_rise_time:
-            if target_set_time > sun_set_time:
-                # target rises after sun_rise but target_set after sun_set
-                start = sun_set_time
-                if target_set_time < sun_rise_time:
-                    end = target_set_time
-                else:
-                    end = sun_rise_time
-        elif target_rise_time < sun_set_time:
-            start = sun_set_time
-            if target_set_time < sun_rise_time:
-                end = target_set_time
-            else:
-                end = sun_rise_time
+    if cache is None:
+        cache = horizons_cache.HorizonsCache()
+    if isinstance(url, basestring):
+        url = [url]
+    url = list(OrderedDict.fromkeys(url))
+    if found_in is None:
+        found_in = {}
 
-        elif sun_set_time < target_rise_time < sun_rise_time:
-            start = target_rise_time
-            if target_set_time < sun_rise_time:
-                end = target_set_time
-            else:
-                end = sun_rise_time
+    good_targets = []
+
+    # the candidates of every list, each object with the row it was first selected from.
+    candidates = OrderedDict()
+    for list_url, table in read_recon_tables(url, list_cache=list_cache).items():
+        table = select_rows(table, start_time, end_time, orbit_classes, min_uncertainty)
+        logging.info("Table at {} contains {} matching entries.".format(list_url, len(table)))
+        for row in table:
+            name = designation(row[OBJ_ID])
+            if name not in candidates:
+                candidates[name] = row
+                found_in[name] = []
+            if list_url not in found_in[name]:
+                found_in[name].append(list_url)
+
+    cfht = visibility.cfht_observer()
+    cfht.date = start_time.iso.replace("-", "/")
 
-        if end is None or start is None:
-            logging.info("Target {} is never up.\n".format(name))
+    if twilight is None:
+        twilight = visibility.TwilightTable(start_time, end_time, cfht)
+    sun_set_time = twilight.night(start_time)[0]
+
+    logging.info("{} distinct objects in {} lists.".format(len(candidates), len(url)))
+
+    # fetch the ephemerides a few at a time, through the cache's rate limited Horizons client.
+    ephemerides = {}
+    n_candidates = len(candidates)
+    for count, (name, ephemeris, error) in enumerate(cache.fetch_many(candidates, start_time, end_time,
+                                                                      center='568'), 1):
+        if error is not None:
+            logging.error("Failed to fetch the ephemeris of {}: {}".format(name, error))
+            del candidates[name]
             continue
-        duration = (end - start).to(units.hour)
+        logging.info("Fetched object {} ({} of {})".format(name, count, n_candidates))
+        ephemerides[name] = ephemeris
+    ephemerides = [ephemerides[name] for name in candidates]
+
+    hours = candidate_hours(list(candidates), ephemerides, start_time, end_time, twilight, observatory=cfht)
+    nights = hours.colnames[1:]
+
+    for (name, row), ephemeris, usable in zip(candidates.items(), ephemerides, hours):
+        usable = numpy.array([usable[night] for night in nights])
+        duration = (len(usable) > 0 and usable.max() or 0.0) * units.hour
         if duration < MINIMUM_UP_TIME:
             logging.info("Skipping traget {}:  only up for {} hours ".format(name, duration))
-            logging.debug("Rise time: {}, Set time: {}".format(start, end))
             continue
+        target = ephem.FixedBody()
+        logging.debug("Getting coordinates from Horizons.")
+        target._ra = math.radians(numpy.interp(sun_set_time.jd, ephemeris['jd'], ephemeris['ra']))
+        target._dec = math.radians(numpy.interp(sun_set_time.jd, ephemeris['jd'], ephemeris['dec']))
+        target.name = name
+        target.mag = numpy.interp(sun_set_time.jd, ephemeris['jd'], ephemeris['mag'])
+        target.compute(cfht)
         good_targets.append(target)
-        logging.debug("{:12s} {:12s} {:10s} {:12s} {:5.2f} {:12s} {:12s} {:5.1f}".format(str(target.ra),
-                                                                                         str(target.dec),
-                                                                                         row[OBJ_ID],
-                                                                                         row[EVENT_TIME],
-                                                                                         row[EPHEM_UNCERTAINTY],
-                                                                                         str(target_rise_time),
-                                                                                         str(target_set_time),
-                                                                                         duration))
-    return good_targets
+        logging.debug("{:12s} {:12s} {:10s} {:12s} {:5.2f} {:5.1f} {:3d}".format(str(target.ra),
+                                                                              str(target.dec),
+                                                                              row[OBJ_ID],
+                                                                              row[EVENT_TIME],
+                                                                              row[EPHEM_UNCERTAINTY],
+                                                                              duration,
+                                                                              int((usable > 0).sum())))
+    return good_targets, hours
+
+
+def parse_recon_table(url, start_time, end_time, orbit_classes, min_uncertainty, twilight=None, cache=None,
+                      list_cache=None, found_in=None):
+    """Parse the HTML tables distributed by the RECON project.
+
+    :return: list of ephem.FixedBody, see select_candidates.
+    """
+    return select_candidates(url, start_time, end_time, orbit_classes, min_uncertainty, twilight=twilight,
+                             cache=cache, list_cache=list_cache, found_in=found_in)[0]
 
 
 main.__doc__ = DESCRIPTION
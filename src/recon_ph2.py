@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Build the CFHT PH2 program for a run straight from a RECON candidate list.
+
+The candidates are selected as by recon_parser, each candidate's ephemeris is built as by minor_planet_ephemeris and
+the targets are packed into observing groups as by ph2, all in one process without writing and reading back the
+intermediate ephemeris files.
+"""
+import argparse
+import logging
+import sys
+from astropy.time import Time
+from astropy import units
+import horizons_cache
+import minor_planet_ephemeris
+import ph2
+import recon_cache
+import recon_parser
+import visibility
+
+
+def main(runid, qrunid, start_time, stop_time, url, orbit_classes, min_uncertainty, step_size=None,
+         query_step=None, tolerance=None, cache=None, pi_login="kavelaars", nrepeats=2, schedule=False,
+         list_cache=None):
+    """
+    Build the PH2 program that tracks the RECON candidates observable between start_time and stop_time.
+
+    :param url: RECON list to select candidates from, see recon_parser.list_urls, or a list of them.
+    :param step_size: spacing of the ephemeris points.
+    :param query_step: spacing of the Horizons grid that is interpolated to step_size, defaults to step_size.
+    :param tolerance: Quantity, keep only the points needed to follow each target to this accuracy.
+    :param cache: horizons_cache.HorizonsCache to fetch the Horizons ephemerides through.
+    :param list_cache: recon_cache.ReconListCache to fetch the RECON lists through.
+    :param schedule: build observing groups of targets observable on the same nights, see ph2.build_program.
+    :return: ph2.Program
+    """
+    start_time = Time(start_time)
+    stop_time = Time(stop_time)
+    if step_size is None:
+        step_size = 30 * units.minute
+    if query_step is None:
+        query_step = step_size
+    if cache is None:
+        cache = horizons_cache.HorizonsCache()
+
+    observatory = visibility.cfht_observer()
+    twilight = visibility.TwilightTable(start_time, stop_time, observatory)
+
+    candidates = recon_parser.parse_recon_table(url, start_time, stop_time, orbit_classes, min_uncertainty,
+                                                twilight=twilight, cache=cache, list_cache=list_cache)
+    ephemerides = cache.fetch_batch([candidate.name for candidate in candidates], start_time, stop_time,
+                                    step_size=query_step, center='568')
+
+    targets = []
+    for candidate in candidates:
+        ephemeris, error = ephemerides[candidate.name]
+        if error is not None:
+            logging.error("Failed to fetch the ephemeris of {}: {}".format(candidate.name, error))
+            continue
+        try:
+            targets.append(minor_planet_ephemeris.make_ephem_target(candidate.name, ephemeris, start_time,
+                                                                    stop_time, step_size, observatory=observatory,
+                                                                    ephem_format='CFHT API', runid=runid,
+                                                                    twilight=twilight, tolerance=tolerance))
+        except Exception as ex:
+            logging.error("Failed to build the ephemeris of {}: {}".format(candidate.name, ex))
+            logging.debug("Ephemeris of {} failed".format(candidate.name), exc_info=True)
+
+    return ph2.build_program(targets, runid, qrunid, pi_login=pi_login, nrepeats=nrepeats, schedule=schedule,
+                             observatory=observatory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('runid')
+    parser.add_argument('qrunid')
+    parser.add_argument('start_time', help="Date at start of dark run.")
+    parser.add_argument('stop_time', help="Date at end of dark run.")
+    recon_parser.add_selection_arguments(parser)
+    parser.add_argument('--step-size', help="size of time step for ephemeris, in minutes.", default=30, type=float)
+    parser.add_argument('--query-step', help="size of time step of the Horizons query, in minutes. "
+                                             "Defaults to the ephemeris step size.", default=None, type=float)
+    parser.add_argument('--tolerance', help="Only keep the ephemeris points needed to follow the target to this "
+                                            "many arcsec by linear interpolation.", default=None, type=float)
+    parser.add_argument('--pi-login', default="kavelaars")
+    parser.add_argument('--nrepeats', help="Number of repeats of each observing group.", default=2, type=int)
+    parser.add_argument('--schedule', help="Build observing groups of targets that are observable on the same "
+                                           "nights.", action="store_true", default=False)
+    parser.add_argument('--gzip', help="Write the PH2 file gzip compressed.", action="store_true", default=False)
+    parser.add_argument('--exposure-config', help="JSON file of the exposure time table, "
+                                                  "see ph2.load_exposure_config.", default=None)
+    parser.add_argument('--verbose', help="Verbose message reporting.", action="store_true", default=False)
+    parser.add_argument('--debug', help="Provide debuging information.", action="store_true", default=False)
+    horizons_cache.add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.exposure_config is not None:
+        ph2.load_exposure_config(args.exposure_config)
+    program = main(args.runid, args.qrunid, args.start_time, args.stop_time,
+                   recon_parser.list_urls(args.list, args.service_url), args.classes, args.min_uncertainty,
+                   step_size=args.step_size * units.minute,
+                   query_step=args.query_step is not None and args.query_step * units.minute or None,
+                   tolerance=args.tolerance is not None and args.tolerance * units.arcsec or None,
+                   cache=horizons_cache.cache_from_args(args), pi_login=args.pi_login, nrepeats=args.nrepeats,
+                   schedule=args.schedule, list_cache=recon_cache.cache_from_args(args))
+    ph2.write_report(program, sys.stdout)
+    program.save('PH2_{}_{}.json{}'.format(args.runid, args.qrunid, args.gzip and '.gz' or ''))
@@ -0,0 +1,306 @@
+"""
+Tests of the Horizons and RECON list caches and of the Horizons client, run offline against saved results and a
+local_server.LocalServer.
+
+Run from this directory with: python -m unittest test_caches
+"""
+import argparse
+import email.utils
+import functools
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy
+from astropy import units
+from astropy.time import Time
+import horizons_cache
+import horizons_client
+import local_server
+import recon_cache
+
+# The part of a Horizons batch reply the ephemeris is parsed from.
+HORIZONS_RESULT = """*******************************************************************************
+ Date_________JDUT, R.A._(ICRF/J2000.0), DEC_(ICRF/J2000.0), dRA*cosD, d(DEC)/dt, APmag,
+*******************************************************************************
+$$SOE
+2458362.500000000, 20.000000000, 7.661000000, -0.064464, -0.900000, 23.760,
+2458362.541666667, 19.999223518, 7.659008819, -1.449094, -1.810364, 23.760,
+2458362.583333333, 19.995583333, 7.656633975, -3.550480, -1.371239, 23.760,
+2458362.625000000, 19.990460786, 7.655542893, -3.253604, -0.233568, 23.760,
+$$EOE
+*******************************************************************************
+"""
+TARGET = '2013 UO17'
+START_TIME = Time('2018-09-01 00:00:00')
+STOP_TIME = Time('2018-09-01 03:00:00')
+STEP_SIZE = 1 * units.hour
+
+
+def write_horizons_results(directory, names):
+    """
+    Save the fixture Horizons result as the reply for each of names, as FileBody and HorizonsHandler read them.
+    """
+    for name in names:
+        with open(os.path.join(directory, "{}.txt".format(name.replace(" ", "_"))), 'w') as f_handle:
+            f_handle.write(HORIZONS_RESULT)
+
+
+class CountingBody(object):
+    """
+    A body_class that counts the queries made through it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = []
+
+    def __call__(self, name, **kwargs):
+        self.names.append(name)
+        return horizons_cache.FileBody(name, directory=self.directory, **kwargs)
+
+
+class HorizonsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.horizons_directory = os.path.join(self.directory, 'horizons')
+        self.cache_directory = os.path.join(self.directory, 'cache')
+        os.mkdir(self.horizons_directory)
+        write_horizons_results(self.horizons_directory, [TARGET])
+        self.body = CountingBody(self.horizons_directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_cache(self, **kwargs):
+        return horizons_cache.HorizonsCache(directory=self.cache_directory, body_class=self.body, **kwargs)
+
+    def fetch(self, cache):
+        return cache.fetch(TARGET, START_TIME, STOP_TIME, STEP_SIZE)
+
+    def test_fetch_is_cached(self):
+        cache = self.make_cache()
+        ephemeris = self.fetch(cache)
+        self.assertEqual(len(ephemeris), 4)
+        self.assertAlmostEqual(ephemeris['ra'][0], 20.0)
+        numpy.testing.assert_array_equal(self.fetch(cache), ephemeris)
+        self.assertEqual(self.body.names, [TARGET])
+
+    def test_ttl_expiry(self):
+        cache = self.make_cache(ttl=1 * units.hour)
+        self.fetch(cache)
+        key = cache.key(TARGET, START_TIME, STOP_TIME, STEP_SIZE)
+        self.assertIsNotNone(cache.get(key))
+        now = time.time()
+        os.utime(cache.filename(key), (now, now - 2 * 3600))
+        self.assertIsNone(cache.get(key))
+        self.assertFalse(os.path.exists(cache.filename(key)))
+        self.fetch(cache)
+        self.assertEqual(len(self.body.names), 2)
+
+    def test_lru_eviction(self):
+        cache = self.make_cache()
+        ephemeris = self.fetch(cache)
+        cache.clear()
+        keys = ['a', 'b', 'c']
+        cache.put(keys[0], ephemeris)
+        cache.put(keys[1], ephemeris)
+        size = os.path.getsize(cache.filename(keys[0]))
+        # 'a' is the older entry, reading it makes 'b' the least recently used.
+        now = time.time()
+        for age, key in ((200, keys[0]), (100, keys[1])):
+            os.utime(cache.filename(key), (now - age, now - age))
+        self.assertIsNotNone(cache.get(keys[0]))
+        cache.max_bytes = 2 * size
+        cache.put(keys[2], ephemeris)
+        self.assertTrue(os.path.exists(cache.filename(keys[0])))
+        self.assertFalse(os.path.exists(cache.filename(keys[1])))
+        self.assertTrue(os.path.exists(cache.filename(keys[2])))
+
+    def test_refresh(self):
+        self.fetch(self.make_cache())
+        cache = self.make_cache(refresh=True)
+        self.fetch(cache)
+        self.fetch(cache)
+        self.assertEqual(len(self.body.names), 3)
+
+    def test_disabled(self):
+        cache = self.make_cache(enabled=False)
+        self.fetch(cache)
+        self.fetch(cache)
+        self.assertEqual(len(self.body.names), 2)
+        self.assertFalse(os.path.exists(self.cache_directory))
+
+    def test_fetch_batch(self):
+        write_horizons_results(self.horizons_directory, ['2014 AB0'])
+        cache = self.make_cache()
+        self.fetch(cache)
+        results = cache.fetch_batch(['2014 AB0', TARGET, 'unknown'], START_TIME, STOP_TIME, STEP_SIZE)
+        self.assertEqual(list(results), ['2014 AB0', TARGET, 'unknown'])
+        self.assertEqual(len(results[TARGET][0]), 4)
+        self.assertIsNone(results['unknown'][0])
+        self.assertIsNotNone(results['unknown'][1])
+        self.assertEqual(sorted(self.body.names), sorted([TARGET, '2014 AB0', 'unknown']))
+
+    def test_cache_from_args(self):
+        parser = argparse.ArgumentParser()
+        horizons_cache.add_cache_arguments(parser)
+        args = ['--cache-directory', self.cache_directory, '--horizons-directory', self.horizons_directory]
+        cache = horizons_cache.cache_from_args(parser.parse_args(args))
+        self.assertTrue(cache.enabled)
+        self.assertFalse(cache.refresh)
+        self.assertIsInstance(cache.body_class, functools.partial)
+        self.assertEqual(len(self.fetch(cache)), 4)
+        self.assertFalse(horizons_cache.cache_from_args(parser.parse_args(args + ['--no-cache'])).enabled)
+        self.assertTrue(horizons_cache.cache_from_args(parser.parse_args(args + ['--refresh'])).refresh)
+
+
+class ReconListCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.www_directory = os.path.join(self.directory, 'www')
+        os.mkdir(self.www_directory)
+        self.write_list("<html><body>first</body></html>")
+        self.server = local_server.LocalServer(self.www_directory).start()
+        self.url = "{}/list.html".format(self.server.url)
+        self.cache = recon_cache.ReconListCache(directory=os.path.join(self.directory, 'cache'), timeout=5)
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def write_list(self, content):
+        with open(os.path.join(self.www_directory, 'list.html'), 'w') as f_handle:
+            f_handle.write(content)
+
+    def statuses(self):
+        return [status for path, status in self.server.requests]
+
+    def test_etag_revalidation(self):
+        self.assertEqual(self.cache.fetch(self.url), "<html><body>first</body></html>")
+        self.assertEqual(self.cache.fetch(self.url), "<html><body>first</body></html>")
+        self.write_list("<html><body>second</body></html>")
+        self.assertEqual(self.cache.fetch(self.url), "<html><body>second</body></html>")
+        self.assertEqual(self.statuses(), [200, 304, 200])
+
+    def test_last_modified_revalidation(self):
+        content = "<html><body>first</body></html>"
+        mtime = os.stat(os.path.join(self.www_directory, 'list.html')).st_mtime
+        self.cache.put(self.url, content, {'etag': None, 'last_modified': email.utils.formatdate(mtime, usegmt=True)})
+        self.assertEqual(self.cache.fetch(self.url), content)
+        self.assertEqual(self.statuses(), [304])
+
+    def test_refresh(self):
+        self.cache.fetch(self.url)
+        self.cache.refresh = True
+        self.cache.fetch(self.url)
+        self.assertEqual(self.statuses(), [200, 200])
+
+    def test_disabled(self):
+        self.cache.enabled = False
+        self.cache.fetch(self.url)
+        self.cache.fetch(self.url)
+        self.assertEqual(self.statuses(), [200, 200])
+        self.assertIsNone(self.cache.get(self.url))
+
+    def test_server_down(self):
+        self.cache.fetch(self.url)
+        self.server.stop()
+        self.server = None
+        self.assertEqual(self.cache.fetch(self.url), "<html><body>first</body></html>")
+        self.cache.enabled = False
+        self.assertRaises(recon_cache.requests.ConnectionError, self.cache.fetch, self.url)
+
+    def test_fetch_all(self):
+        with open(os.path.join(self.www_directory, 'other.html'), 'w') as f_handle:
+            f_handle.write("<html><body>other</body></html>")
+        other = "{}/other.html".format(self.server.url)
+        lists = self.cache.fetch_all([self.url, other, self.url])
+        self.assertEqual(list(lists), [self.url, other])
+        self.assertEqual(lists[other], "<html><body>other</body></html>")
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class RetryAfterHandler(local_server.HorizonsHandler):
+    """
+    A HorizonsHandler that asks for a one second wait when it is busy.
+    """
+
+    def respond(self, status, content='', content_type='text/plain', headers=None):
+        if status == 503:
+            headers = dict(headers or {}, **{'Retry-After': '1'})
+        local_server.HorizonsHandler.respond(self, status, content, content_type=content_type, headers=headers)
+
+
+class HorizonsClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        write_horizons_results(self.directory, [TARGET])
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def make_client(self, handler_class=local_server.HorizonsHandler, **kwargs):
+        self.server = local_server.LocalServer(self.directory, handler_class=handler_class).start()
+        kwargs.setdefault('rate', 100)
+        kwargs.setdefault('backoff', 0)
+        return horizons_client.HorizonsClient(url="{}/{}".format(self.server.url, local_server.HORIZONS_END_POINT),
+                                              timeout=5, **kwargs)
+
+    def statuses(self):
+        return [status for path, status in self.server.requests]
+
+    def test_query(self):
+        client = self.make_client()
+        cache = horizons_cache.HorizonsCache(enabled=False, body_class=client.body_class)
+        ephemeris = cache.fetch(TARGET, START_TIME, STOP_TIME, STEP_SIZE)
+        self.assertEqual(len(ephemeris), 4)
+        self.assertEqual(self.statuses(), [200])
+
+    def test_retry_when_busy(self):
+        client = self.make_client(retries=3)
+        self.server.throttle = 2
+        self.assertIn('$$SOE', client.get({'COMMAND': "'{}'".format(TARGET)}))
+        self.assertEqual(self.statuses(), [503, 503, 200])
+
+    def test_retries_exhausted(self):
+        client = self.make_client(retries=2)
+        self.server.throttle = 5
+        self.assertRaises(IOError, client.get, {'COMMAND': "'{}'".format(TARGET)})
+        self.assertEqual(self.statuses(), [503, 503, 503])
+
+    def test_backoff(self):
+        client = self.make_client(retries=2, backoff=0.2)
+        self.server.throttle = 2
+        start = time.time()
+        client.get({'COMMAND': "'{}'".format(TARGET)})
+        # 0.2s before the first retry and 0.4s before the second.
+        self.assertGreaterEqual(time.time() - start, 0.6)
+        self.assertEqual(self.statuses(), [503, 503, 200])
+
+    def test_retry_after(self):
+        client = self.make_client(handler_class=RetryAfterHandler, retries=1)
+        self.server.throttle = 1
+        start = time.time()
+        client.get({'COMMAND': "'{}'".format(TARGET)})
+        self.assertGreaterEqual(time.time() - start, 1.0)
+        self.assertEqual(self.statuses(), [503, 200])
+
+    def test_unknown_target(self):
+        client = self.make_client()
+        cache = horizons_cache.HorizonsCache(enabled=False, body_class=client.body_class)
+        results = cache.fetch_batch(['unknown', TARGET], START_TIME, STOP_TIME, STEP_SIZE)
+        self.assertIsNone(results['unknown'][0])
+        self.assertEqual(len(results[TARGET][0]), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
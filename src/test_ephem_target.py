@@ -0,0 +1,66 @@
+"""
+Tests of the ephemeris file writers.
+
+Run from this directory with: python -m unittest test_ephem_target
+"""
+import unittest
+from cStringIO import StringIO
+import numpy
+from astropy import units
+from astropy.time import Time
+import ephem_target
+
+
+def minidom_cfht_et(target):
+    """
+    The CFHT ET document of target as minidom writes it, the way cfht_writer wrote it before it was streamed.
+    """
+    target._init_cfht_et_file()
+    target.cdata.appendData(target._cdata_rows(target.points))
+    f_handle = StringIO()
+    target.doc.writexml(f_handle, indent="  ", addindent="  ", newl='\n')
+    return f_handle.getvalue()
+
+
+def streamed_cfht_et(target):
+    f_handle = StringIO()
+    target.cfht_writer(f_handle)
+    return f_handle.getvalue()
+
+
+def make_target(name, n_points):
+    """
+    An EphemTarget on a track of n_points, ten minutes apart.
+    """
+    target = ephem_target.EphemTarget(name)
+    if n_points == 0:
+        return target
+    steps = numpy.arange(n_points)
+    target.extend(Time('2018-09-01 00:00:00') + steps * 10 * units.minute, 25.0 + steps * 1e-4,
+                  7.5 - steps * 1e-4, numpy.full(n_points, 23.5))
+    return target
+
+
+class CFHTWriterTest(unittest.TestCase):
+
+    def assertMatchesMinidom(self, target):
+        streamed = streamed_cfht_et(target)
+        self.assertEqual(streamed, minidom_cfht_et(target))
+        return streamed
+
+    def test_track(self):
+        # longer than one block of rows, so the blocks are joined.
+        n_points = ephem_target.ROWS_PER_WRITE + 1000
+        streamed = self.assertMatchesMinidom(make_target('2013 UO17', n_points))
+        self.assertEqual(streamed.count('|\n'), n_points + 4)
+
+    def test_empty(self):
+        self.assertMatchesMinidom(make_target('2013 UO17', 0))
+
+    def test_escaping(self):
+        streamed = self.assertMatchesMinidom(make_target('A&B<C>"D"', 3))
+        self.assertIn('A&amp;B&lt;C&gt;&quot;D&quot;', streamed)
+
+
+if __name__ == '__main__':
+    unittest.main()
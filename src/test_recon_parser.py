@@ -0,0 +1,69 @@
+"""
+Tests of the RECON list parser, run on a saved RECON-shaped page.
+
+Run from this directory with: python -m unittest test_recon_parser
+"""
+import os
+import unittest
+import numpy
+import recon_parser
+
+RECON_PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'reconlist.html')
+
+
+def parse_html5lib(text):
+    """
+    Parse a page the way HTMLTableParser.parse_text does when lxml is not installed.
+    """
+    lxml_html = recon_parser.lxml_html
+    recon_parser.lxml_html = None
+    try:
+        return recon_parser.HTMLTableParser().parse_text(text)
+    finally:
+        recon_parser.lxml_html = lxml_html
+
+
+class HTMLTableParserTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(RECON_PAGE, 'rb') as f_handle:
+            self.text = f_handle.read()
+
+    @unittest.skipIf(recon_parser.lxml_html is None, "lxml is not installed")
+    def test_lxml_matches_html5lib(self):
+        tables = recon_parser.HTMLTableParser().parse_text(self.text)
+        expected = parse_html5lib(self.text)
+        self.assertEqual([table_id for table_id, frame in tables], [table_id for table_id, frame in expected])
+        for (table_id, frame), (expected_id, expected_frame) in zip(tables, expected):
+            self.assertEqual(list(frame.columns), list(expected_frame.columns))
+            self.assertEqual(list(frame.dtypes), list(expected_frame.dtypes))
+            self.assertTrue(frame.equals(expected_frame), "table {!r} differs".format(table_id))
+            self.assertEqual([type(value) for value in frame.values.ravel()],
+                             [type(value) for value in expected_frame.values.ravel()])
+
+    def test_events_table(self):
+        for tables in (recon_parser.HTMLTableParser().parse_text(self.text), parse_html5lib(self.text)):
+            self.assertEqual([table_id for table_id, frame in tables], ['events', ''])
+            frame = tables[0][1]
+            self.assertEqual(list(frame.columns), [recon_parser.OBJ_ID, 'Name', recon_parser.ORB_CLASS,
+                                                   recon_parser.EPHEM_UNCERTAINTY, recon_parser.EVENT_TIME,
+                                                   'Star mag', 'Prob', 'Notes'])
+            self.assertEqual(len(frame), 8)
+            self.assertEqual(frame[recon_parser.EPHEM_UNCERTAINTY].dtype, numpy.dtype('f8'))
+            self.assertEqual(frame['Name'][1], u"2014 AB0 \u2020")
+            self.assertEqual(frame['Name'][4], u"2015 RR245")
+            self.assertEqual(frame['Notes'][1], u"Chord & timing <1s")
+            # cells missing from the end of a short row are NaN.
+            self.assertTrue(numpy.isnan(frame['Notes'][5]))
+            self.assertTrue(numpy.isnan(frame['Prob'][6]))
+            # the summary table has no <th>, its first row names the columns.
+            self.assertEqual(list(tables[1][1].columns), [u'Class', u'Count'])
+
+    def test_read_recon_tables(self):
+        table = recon_parser.read_recon_tables([RECON_PAGE])[RECON_PAGE]
+        self.assertEqual(len(table), 8)
+        self.assertEqual(list(table[recon_parser.OBJ_ID][:2]), [u'13UO17', u'14AB0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
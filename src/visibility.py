@@ -0,0 +1,367 @@
+"""
+Vectorized night and target visibility computations for CFHT.
+
+These routines take a whole grid of times as a single astropy Time array and compute the Sun and target altitude
+with numpy, rather than stepping an ephem.Observer through the run one time step at a time.  The formulae follow
+the low precision algorithms of the Astronomical Almanac and the refraction model used by libastro (the engine
+behind pyephem) so that the masks agree with the ephem rise/set times used previously.
+"""
+import collections
+import math
+import ephem
+import numpy
+from astropy import units
+from astropy.time import Time
+
+# CFHT site, matching the ephem.Observer used in minor_planet_ephemeris and recon_parser.
+CFHT_LATITUDE = 0.344
+CFHT_LONGITUDE = -2.707
+CFHT_ELEVATION = 4100
+
+# ephem.Observer defaults, used for refraction when no observer is given.
+DEFAULT_PRESSURE = 1010.0
+DEFAULT_TEMPERATURE = 15.0
+
+MINIMUM_ELEVATION = 40 * units.degree
+TWILIGHT_ELEVATION = -7 * units.degree
+
+# ephem computes Sun rise/set for the upper limb.
+SUN_SEMIDIAMETER = 0.2666
+
+J2000 = 2451545.0
+
+# The parts of an ephem.Observer used here, in a form that can be pickled.
+Site = collections.namedtuple('Site', ['lat', 'lon', 'pressure', 'temp'])
+
+# ephem.Date counts days from 1899 December 31 12:00 UT.
+EPHEM_DATE_MJD_OFFSET = 15019.5
+
+
+def site(observatory):
+    """
+    Describe an ephem.Observer as a Site, which can be passed to other processes in place of the observer.
+    """
+    return Site(*_site(observatory))
+
+
+def _site(observatory):
+    """
+    Return (latitude, longitude, pressure, temperature) of an ephem.Observer like object, defaulting to CFHT.
+
+    latitude and longitude are in radians.
+    """
+    if observatory is None:
+        return CFHT_LATITUDE, CFHT_LONGITUDE, DEFAULT_PRESSURE, DEFAULT_TEMPERATURE
+    return (float(observatory.lat), float(observatory.lon),
+            getattr(observatory, 'pressure', DEFAULT_PRESSURE),
+            getattr(observatory, 'temp', DEFAULT_TEMPERATURE))
+
+
+def cfht_observer():
+    """
+    An ephem.Observer at CFHT.
+    """
+    observer = ephem.Observer()
+    observer.lat = CFHT_LATITUDE
+    observer.lon = CFHT_LONGITUDE
+    observer.elevation = CFHT_ELEVATION
+    return observer
+
+
+def sidereal_time(jd, longitude):
+    """
+    Local mean sidereal time (IAU 1982), in radians.
+
+    :param jd: numpy array of UT julian dates
+    :param longitude: east longitude of the site, in radians.
+    :return: numpy array
+    """
+    t = (jd - J2000) / 36525.0
+    gmst = (280.46061837 + 360.98564736629 * (jd - J2000) + 0.000387933 * t ** 2 - t ** 3 / 38710000.0)
+    return numpy.radians(gmst % 360.0) + longitude
+
+
+def precess(ra, dec, jd):
+    """
+    Precess J2000 coordinates to the mean equator and equinox of date (IAU 1976).
+
+    :param ra: numpy array of right ascensions, in radians.
+    :param dec: numpy array of declinations, in radians.
+    :param jd: numpy array of julian dates
+    :return: (ra, dec) of date, in radians.
+    """
+    t = (jd - J2000) / 36525.0
+    zeta = numpy.radians((2306.2181 * t + 0.30188 * t ** 2 + 0.017998 * t ** 3) / 3600.0)
+    z = numpy.radians((2306.2181 * t + 1.09468 * t ** 2 + 0.018203 * t ** 3) / 3600.0)
+    theta = numpy.radians((2004.3109 * t - 0.42665 * t ** 2 - 0.041833 * t ** 3) / 3600.0)
+    a = numpy.cos(dec) * numpy.sin(ra + zeta)
+    b = numpy.cos(theta) * numpy.cos(dec) * numpy.cos(ra + zeta) - numpy.sin(theta) * numpy.sin(dec)
+    c = numpy.sin(theta) * numpy.cos(dec) * numpy.cos(ra + zeta) + numpy.cos(theta) * numpy.sin(dec)
+    return numpy.arctan2(a, b) + z, numpy.arcsin(numpy.clip(c, -1.0, 1.0))
+
+
+def sun_position(jd):
+    """
+    Apparent equatorial coordinates of the Sun, of date, using the Astronomical Almanac low precision formulae.
+
+    Good to about 0.01 degrees between 1950 and 2050.
+
+    :param jd: numpy array of julian dates
+    :return: (ra, dec) in radians.
+    """
+    n = jd - J2000
+    mean_longitude = numpy.radians((280.460 + 0.9856474 * n) % 360.0)
+    mean_anomaly = numpy.radians((357.528 + 0.9856003 * n) % 360.0)
+    longitude = (mean_longitude + numpy.radians(1.915) * numpy.sin(mean_anomaly) +
+                 numpy.radians(0.020) * numpy.sin(2 * mean_anomaly))
+    obliquity = numpy.radians(23.439 - 0.0000004 * n)
+    ra = numpy.arctan2(numpy.cos(obliquity) * numpy.sin(longitude), numpy.cos(longitude))
+    dec = numpy.arcsin(numpy.sin(obliquity) * numpy.sin(longitude))
+    return ra, dec
+
+
+def refraction(altitude, pressure=DEFAULT_PRESSURE, temperature=DEFAULT_TEMPERATURE):
+    """
+    Atmospheric refraction at an apparent altitude, as modelled by libastro.
+
+    :param altitude: numpy array of apparent altitudes, in radians.
+    :return: numpy array of refraction, in radians.
+    """
+    degrees = numpy.degrees(altitude)
+    low = ((0.1594 + 0.0196 * degrees + 2e-5 * degrees ** 2) * pressure /
+           ((273.0 + temperature) * (1 + 0.505 * degrees + 0.0845 * degrees ** 2)))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        high = numpy.degrees(7.888888e-5 * pressure / ((273.0 + temperature) * numpy.tan(altitude)))
+    return numpy.radians(numpy.clip(numpy.where(degrees < 15.0, low, high), 0.0, None))
+
+
+def true_altitude(altitude, observatory=None):
+    """
+    Convert an apparent altitude (eg. a horizon) to the geometric altitude it corresponds to.
+
+    :param altitude: Quantity, apparent altitude.
+    :param observatory: ephem.Observer, defaults to CFHT.
+    :return: float, geometric altitude in degrees.
+    """
+    pressure, temperature = _site(observatory)[2:]
+    altitude = altitude.to(units.radian).value
+    return math.degrees(altitude - refraction(altitude, pressure, temperature))
+
+
+def _altitude(jd, ra, dec, latitude, longitude):
+    hour_angle = sidereal_time(jd, longitude) - ra
+    sin_alt = (numpy.sin(latitude) * numpy.sin(dec) +
+               numpy.cos(latitude) * numpy.cos(dec) * numpy.cos(hour_angle))
+    return numpy.arcsin(numpy.clip(sin_alt, -1.0, 1.0))
+
+
+def sun_altitude(times, observatory=None):
+    """
+    Geometric altitude of the upper limb of the Sun.
+
+    :param times: Time array of the grid to compute on.
+    :param observatory: ephem.Observer, defaults to CFHT.
+    :return: numpy array of altitudes, in degrees.
+    """
+    latitude, longitude = _site(observatory)[:2]
+    jd = numpy.atleast_1d(times.utc.jd)
+    ra, dec = sun_position(jd)
+    return numpy.degrees(_altitude(jd, ra, dec, latitude, longitude)) + SUN_SEMIDIAMETER
+
+
+def target_altitude(times, ra, dec, observatory=None):
+    """
+    Geometric altitude of a target given its J2000 position at each time.
+
+    :param times: Time array of the grid to compute on.
+    :param ra: numpy array of J2000 right ascensions, in degrees, one per time (or a scalar).
+    :param dec: numpy array of J2000 declinations, in degrees, one per time (or a scalar).
+    :param observatory: ephem.Observer, defaults to CFHT.
+    :return: numpy array of altitudes, in degrees.
+    """
+    latitude, longitude = _site(observatory)[:2]
+    jd = numpy.atleast_1d(times.utc.jd)
+    ra, dec = precess(numpy.radians(ra), numpy.radians(dec), jd)
+    return numpy.degrees(_altitude(jd, ra, dec, latitude, longitude))
+
+
+def night_mask(times, ra, dec, observatory=None, min_elevation=MINIMUM_ELEVATION, sun_elevation=TWILIGHT_ELEVATION,
+               twilight=None):
+    """
+    Determine at which times the target is above min_elevation while the Sun is below sun_elevation.
+
+    Both elevations are apparent, like an ephem.Observer horizon, and are converted to geometric altitudes once
+    rather than refracting every altitude on the grid.  When a TwilightTable is given the Sun is looked up in
+    it instead and sun_elevation is ignored.
+
+    :param times: Time array of the grid to compute on.
+    :param ra: numpy array of J2000 right ascensions, in degrees, one per time.
+    :param dec: numpy array of J2000 declinations, in degrees, one per time.
+    :param observatory: ephem.Observer, defaults to CFHT.
+    :param min_elevation: Quantity, lowest elevation the target is usable at.
+    :param sun_elevation: Quantity, elevation the Sun must be below.
+    :param twilight: TwilightTable covering times.
+    :return: numpy boolean array, True where the target can be observed.
+    """
+    if twilight is not None:
+        sun_down = twilight.is_dark(times)
+    else:
+        sun_down = sun_altitude(times, observatory) < true_altitude(sun_elevation, observatory)
+    target_up = target_altitude(times, ra, dec, observatory) > true_altitude(min_elevation, observatory)
+    return sun_down & target_up
+
+
+def usable_hours(times, ra, dec, twilight, observatory=None, min_elevation=MINIMUM_ELEVATION):
+    """
+    Compute the hours each of a set of targets is above min_elevation while the Sun is down, in every night of a
+    TwilightTable, with all the targets and times evaluated at once.
+
+    Each time the target is up and the Sun down counts for one step of the (evenly spaced) time grid.
+
+    :param times: Time array of the grid to compute on.
+    :param ra: numpy array of J2000 right ascensions, in degrees, one row per target and one column per time.
+    :param dec: numpy array of J2000 declinations, in degrees, shaped as ra.
+    :param twilight: TwilightTable covering times.
+    :param observatory: ephem.Observer, defaults to CFHT.
+    :param min_elevation: Quantity, lowest elevation a target is usable at.
+    :return: numpy array of hours, one row per target and one column per night of the twilight table.
+    """
+    mjd = numpy.atleast_1d(times.utc.mjd)
+    step = len(mjd) > 1 and (mjd[1] - mjd[0]) * 24.0 or 0.0
+    dark = twilight.is_dark(times)
+    night = numpy.searchsorted(twilight.sunset, mjd, side='right') - 1
+    up = numpy.atleast_2d(target_altitude(times, ra, dec, observatory) > true_altitude(min_elevation, observatory))
+    # count the dark steps each target is up in each night, with one bin per (target, night).
+    n_targets, n_nights = len(up), len(twilight)
+    bins = (numpy.arange(n_targets)[:, numpy.newaxis] * n_nights + night[dark]).ravel()
+    counts = numpy.bincount(bins, weights=up[:, dark].ravel(), minlength=n_targets * n_nights)
+    return counts.reshape(n_targets, n_nights) * step
+
+
+def windows(mask):
+    """
+    Find the runs of consecutive True values in a mask, eg. the nights a target is observable in a night_mask.
+
+    :param mask: numpy boolean array
+    :return: list of (first, last) index pairs, inclusive.
+    """
+    edges = numpy.diff(numpy.concatenate(([0], numpy.asarray(mask, dtype='i1'), [0])))
+    return list(zip(numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1) - 1))
+
+
+def local_night(mjd, observatory=None):
+    """
+    Label each time with the night it falls in, nights running from local noon to local noon.
+
+    :param mjd: numpy array of UTC MJDs.
+    :param observatory: ephem.Observer, defaults to CFHT.
+    :return: numpy array of int, the MJD of the local date on which each night starts.
+    """
+    longitude = _site(observatory)[1]
+    return numpy.floor(numpy.asarray(mjd) + longitude / (2 * math.pi) - 0.5).astype(int)
+
+
+def night_label(night):
+    """
+    The date, as YYYY-MM-DD, on which a night, see local_night, starts.
+    """
+    return Time(night, format='mjd').iso[:10]
+
+
+def nightly_windows(mjd, observatory=None):
+    """
+    Find the span of times in each night, eg. of the ephemeris points of a target, which are only written for the
+    times it is observable.
+
+    :param mjd: numpy array of UTC MJDs, in increasing order.
+    :param observatory: ephem.Observer, defaults to CFHT.
+    :return: numpy arrays of the nights (see local_night) and the first and last MJD in each night.
+    """
+    mjd = numpy.asarray(mjd, dtype='f8')
+    if len(mjd) == 0:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0), numpy.zeros(0)
+    nights = local_night(mjd, observatory)
+    first = numpy.flatnonzero(numpy.concatenate(([True], nights[1:] != nights[:-1])))
+    last = numpy.concatenate((first[1:], [len(mjd)])) - 1
+    return nights[first], mjd[first], mjd[last]
+
+
+def time_grid(start_time, stop_time, step_size):
+    """
+    Build the grid of times start_time, start_time + step_size, ... up to, but not including, stop_time.
+
+    :param start_time: Time
+    :param stop_time: Time
+    :param step_size: Quantity
+    :return: Time array
+    """
+    n_steps = int(math.ceil(((stop_time - start_time) / step_size).decompose().value))
+    return start_time + numpy.arange(max(n_steps, 0)) * step_size
+
+
+class TwilightTable(object):
+    """
+    The evening and morning twilight of every night in a date range, computed once with ephem.
+
+    Each night is a (sunset, sunrise) pair at the twilight elevation, stored as MJD arrays so that any number of
+    targets and time steps can be checked against the table by bisection without recomputing the Sun.
+    """
+
+    def __init__(self, start_time, stop_time, observatory=None, sun_elevation=TWILIGHT_ELEVATION):
+        """
+        :param start_time: Time, the first night in the table is the one in progress, or next starting, at start_time.
+        :param stop_time: Time, the last night in the table is the one in progress at stop_time.
+        :param observatory: ephem.Observer, defaults to CFHT.
+        :param sun_elevation: Quantity, the Sun elevation that defines twilight.
+        """
+        if observatory is None:
+            observatory = cfht_observer()
+        observer = observatory.copy()
+        observer.horizon = sun_elevation.to(units.radian).value
+        sun = ephem.Sun()
+
+        start = Time(start_time).mjd
+        stop = Time(stop_time).mjd
+        sunsets = []
+        sunrises = []
+        date = ephem.Date(start - 1 - EPHEM_DATE_MJD_OFFSET)
+        while True:
+            sunset = observer.next_setting(sun, start=date)
+            sunrise = observer.next_rising(sun, start=sunset)
+            if sunset > stop - EPHEM_DATE_MJD_OFFSET:
+                break
+            if sunrise >= start - EPHEM_DATE_MJD_OFFSET:
+                sunsets.append(sunset)
+                sunrises.append(sunrise)
+            date = sunrise
+        self.sunset = numpy.array(sunsets) + EPHEM_DATE_MJD_OFFSET
+        self.sunrise = numpy.array(sunrises) + EPHEM_DATE_MJD_OFFSET
+
+    def __len__(self):
+        return len(self.sunset)
+
+    def night(self, time):
+        """
+        The twilight times of the night in progress at time, or of the next night if it is day time.
+
+        :param time: Time
+        :return: (sunset, sunrise) as Time objects
+        """
+        idx = numpy.searchsorted(self.sunrise, Time(time).mjd)
+        if idx >= len(self):
+            raise ValueError("{} is after the last night in the twilight table.".format(time))
+        return (Time(self.sunset[idx], format='mjd', scale='utc'),
+                Time(self.sunrise[idx], format='mjd', scale='utc'))
+
+    def is_dark(self, times):
+        """
+        Determine which times fall between sunset and sunrise.
+
+        :param times: Time array
+        :return: numpy boolean array
+        """
+        mjd = numpy.atleast_1d(times.utc.mjd)
+        idx = numpy.searchsorted(self.sunset, mjd, side='right') - 1
+        dark = idx >= 0
+        dark[dark] = mjd[dark] <= self.sunrise[idx[dark]]
+        return dark